@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Measures the cost of the wire codecs on locals dumps shaped like the output of
+gdb_to_py.
+
+    python bench/codec_bench.py [nodes ...]
+"""
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from protocol import CODECS
+
+def make_locals(nodes, fanout=10):
+    """Builds a tree of about `nodes` entries mixing leaves, lazily expandable
+    children and nested structs, like a locals response would."""
+    count = [ 0 ]
+
+    def _struct(depth):
+        contents = {}
+        for i in range(fanout):
+            if count[0] >= nodes:
+                break
+            count[0] += 1
+            if i % 3 == 0 and depth < 4:
+                contents["field_%d (struct node_%d)" % (i, depth)] = _struct(depth + 1)
+            elif i % 3 == 1:
+                contents["ptr_%d (node *) @0x%x" % (i, 0x7ffc0000 + count[0])] = "this->ptr_%d" % i
+            else:
+                contents["value_%d (int): %d" % (i, count[0])] = 0
+        return contents
+
+    variables = {}
+    while count[0] < nodes:
+        count[0] += 1
+        variables["var_%d (struct node_0)" % count[0]] = _struct(1)
+    return { 'dst': 'vim', 'op': 'response', 'request_id': 1, 'expr': 'locals', 'contents': variables }
+
+def measure(codec, packet, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        data = codec.dumps(packet)
+    encode = (time.time() - start) / repeat
+    start = time.time()
+    for _ in range(repeat):
+        codec.loads(data)
+    decode = (time.time() - start) / repeat
+    return encode, decode, len(data)
+
+if __name__ == '__main__':
+    sizes = [ int(arg) for arg in sys.argv[1:] ] or [ 1000, 10000, 100000 ]
+    print("%-12s %8s %12s %12s %12s" % ("codec", "nodes", "encode (ms)", "decode (ms)", "bytes"))
+    for nodes in sizes:
+        packet = make_locals(nodes)
+        repeat = max(1, int(100000 / nodes))
+        for codec in CODECS:
+            encode, decode, size = measure(codec, packet, repeat)
+            print("%-12s %8d %12.3f %12.3f %12d" % (codec.name, nodes, encode * 1000, decode * 1000, size))
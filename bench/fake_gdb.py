@@ -0,0 +1,135 @@
+"""
+A small stand-in for gdb's Python API, good enough to drive gdb_values outside
+of gdb.  Values are plain Python objects, so benchmarks built on it measure
+the Python side of the conversion rather than gdb's own costs.
+
+    import fake_gdb; fake_gdb.install()
+"""
+import sys
+
+TYPE_CODE_PTR = 1
+TYPE_CODE_ARRAY = 2
+TYPE_CODE_STRUCT = 3
+TYPE_CODE_UNION = 4
+TYPE_CODE_ENUM = 5
+TYPE_CODE_FUNC = 7
+TYPE_CODE_INT = 8
+TYPE_CODE_FLT = 9
+TYPE_CODE_VOID = 10
+TYPE_CODE_BOOL = 20
+TYPE_CODE_CHAR = 19
+TYPE_CODE_REF = 16
+TYPE_CODE_TYPEDEF = 23
+
+class error(RuntimeError):
+    pass
+
+class MemoryError(error):
+    pass
+
+class Field(object):
+    def __init__(self, name, type, is_base_class=False):
+        self.name = name
+        self.type = type
+        self.is_base_class = is_base_class
+
+class Type(object):
+    def __init__(self, code, name, sizeof, target=None, fields=(), template_args=()):
+        self.code = code
+        self._name = name
+        self.sizeof = sizeof
+        self._target = target
+        self._fields = list(fields)
+        self._template_args = list(template_args)
+
+    def __str__(self):
+        return self._name
+
+    def target(self):
+        return self._target
+
+    def fields(self):
+        return self._fields
+
+    def unqualified(self):
+        return self
+
+    def strip_typedefs(self):
+        return self._target.strip_typedefs() if self.code == TYPE_CODE_TYPEDEF else self
+
+    def template_argument(self, n):
+        return self._template_args[n]
+
+    def pointer(self):
+        return Type(TYPE_CODE_PTR, self._name + ' *', 8, target=self)
+
+    def array(self, n):
+        return Type(TYPE_CODE_ARRAY, '%s [%d]' % (self._name, n + 1), self.sizeof * (n + 1), target=self)
+
+class Value(object):
+    """`payload` is an int or float for scalars, a dict of field values for
+    structs, a list of element values for arrays, the pointee (or None) for
+    pointers and a str for char pointers."""
+    def __init__(self, type, payload, address=None):
+        self.type = type
+        self._payload = payload
+        self.address = address
+
+    def _code(self):
+        return self.type.strip_typedefs().code
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self._payload[key]
+        return self._payload[key]
+
+    def __int__(self):
+        if self._code() == TYPE_CODE_PTR:
+            return 0 if self._payload is None else 0x7ffc0000 + id(self._payload) % 0x10000
+        return int(self._payload)
+
+    def __str__(self):
+        code = self._code()
+        if code == TYPE_CODE_PTR:
+            return '0x%x' % int(self)
+        if code in (TYPE_CODE_STRUCT, TYPE_CODE_UNION, TYPE_CODE_ARRAY):
+            return '{...}'
+        return str(self._payload)
+
+    def dereference(self):
+        if self._payload is None:
+            raise MemoryError("Cannot access memory at address 0x0")
+        return self._payload
+
+    def cast(self, t):
+        return Value(t, self._payload, self.address)
+
+    def string(self, encoding=None):
+        return self._payload
+
+_types = {}
+
+def lookup_type(name):
+    return _types[name]
+
+def selected_frame():
+    raise error("No frame is selected.")
+
+pretty_printers = []
+
+def default_visualizer(value):
+    for printer in pretty_printers:
+        found = printer(value)
+        if found is not None:
+            return found
+    return None
+
+def install():
+    sys.modules['gdb'] = sys.modules[__name__]
+
+char = Type(TYPE_CODE_INT, 'char', 1)
+int_t = Type(TYPE_CODE_INT, 'int', 4)
+double_t = Type(TYPE_CODE_FLT, 'double', 8)
+void = Type(TYPE_CODE_VOID, 'void', 1)
+for t in (char, int_t, double_t, void):
+    _types[str(t)] = t
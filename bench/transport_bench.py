@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Measures round trip latency of each transport the proxy can use, with an
+echoing child process at the far end.
+
+    python bench/transport_bench.py [payload bytes ...]
+"""
+import os, sys, time, socket
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+from multiprocessing import Pipe
+from multiprocessing.connection import Listener, Client
+from protocol import ProtocolSocket, StreamSocket, ShmSocket, UnixListener
+
+def pipe():
+    a, b = Pipe(True)
+    return lambda: a, lambda: b
+
+def tcp():
+    server = Listener(('localhost', 0))
+    return lambda: server.accept(), lambda: Client(server.address)
+
+def unix():
+    server = UnixListener()
+    return lambda: server.accept(), lambda: StreamSocket.connect_unix(server.address)
+
+def socketpair():
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    return lambda: StreamSocket(a), lambda: StreamSocket(b)
+
+def shm():
+    a, b = ShmSocket.pair()
+    return lambda: a, lambda: b
+
+CODEC = 'marshal-py%d' % sys.version_info[0]
+
+TRANSPORTS = [
+    ('pipe', pipe),
+    ('tcp', tcp),
+    ('unix', unix),
+    ('socketpair', socketpair),
+    ('shm', shm),
+]
+
+def measure(transport, payload, repeat):
+    """Median round trip in seconds of a packet carrying `payload`."""
+    local, remote = transport()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            sock = ProtocolSocket(remote())
+            sock.set_codec(CODEC)
+            while True:
+                c = sock.recv_packet()
+                if c['op'] == 'quit':
+                    break
+                sock.send_packet(**c)
+        finally:
+            os._exit(0)
+    sock = ProtocolSocket(local())
+    sock.set_codec(CODEC)
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        sock.send_packet(dst='echo', op='echo', payload=payload)
+        sock.recv_packet()
+        times.append(time.time() - start)
+    sock.send_packet(dst='echo', op='quit')
+    os.waitpid(pid, 0)
+    times.sort()
+    return times[len(times) // 2]
+
+if __name__ == '__main__':
+    sizes = [ int(arg) for arg in sys.argv[1:] ] or [ 64, 65536, 1 << 20, 8 << 20 ]
+    print("%-12s %10s %14s" % ("transport", "bytes", "round trip (us)"))
+    for size in sizes:
+        payload = 'x' * size
+        repeat = max(5, min(2000, int((64 << 20) / max(size, 1))))
+        for name, transport in TRANSPORTS:
+            print("%-12s %10d %14.1f" % (name, size, measure(transport, payload, repeat) * 1e6))
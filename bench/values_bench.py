@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Times gdb_to_py against the fake gdb module on a struct with thousands of
+fields and on element-by-element expansion of an array of structs.
+
+    python bench/values_bench.py [--reference path/to/other/gdb_values.py]
+
+With --reference, the same workloads also run against another copy of
+gdb_values (for instance one checked out from an older revision).
+"""
+import os, sys, time
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, '..', 'lib'))
+
+import fake_gdb
+fake_gdb.install()
+from fake_gdb import Type, Value, Field, char, int_t, double_t
+
+def make_types():
+    counter = Type(fake_gdb.TYPE_CODE_TYPEDEF, 'counter_t', 4, target=int_t)
+    leaf = Type(fake_gdb.TYPE_CODE_STRUCT, 'leaf', 32)
+    leaf._fields = [ Field('id', int_t), Field('weight', double_t), Field('label', char.pointer()),
+                     Field('count', counter), Field('next', leaf.pointer()) ]
+    return leaf, counter
+
+def make_leaf(leaf, counter, i, next=None):
+    return Value(leaf, {
+        'id': Value(int_t, i),
+        'weight': Value(double_t, i * 0.5),
+        'label': Value(char.pointer(), 'leaf %d' % i),
+        'count': Value(counter, i % 7),
+        'next': Value(leaf.pointer(), next),
+    })
+
+def wide_struct(fields):
+    leaf, counter = make_types()
+    wide = Type(fake_gdb.TYPE_CODE_STRUCT, 'wide', 8 * fields)
+    payload = {}
+    for i in range(fields):
+        kind = i % 4
+        name = 'field_%d' % i
+        if kind == 0:
+            wide._fields.append(Field(name, int_t))
+            payload[name] = Value(int_t, i)
+        elif kind == 1:
+            wide._fields.append(Field(name, counter))
+            payload[name] = Value(counter, i)
+        elif kind == 2:
+            wide._fields.append(Field(name, char.pointer()))
+            payload[name] = Value(char.pointer(), 'value %d' % i)
+        else:
+            wide._fields.append(Field(name, leaf.pointer()))
+            payload[name] = Value(leaf.pointer(), make_leaf(leaf, counter, i))
+    return Value(wide, payload)
+
+def struct_array(length):
+    leaf, counter = make_types()
+    elements = [ make_leaf(leaf, counter, i) for i in range(length) ]
+    return Value(leaf.array(length - 1), elements)
+
+def load_source(name, path):
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def timed(fn, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - start) / repeat * 1000
+
+def run(module, label):
+    wide = wide_struct(5000)
+    array = struct_array(2000)
+    cold = timed(lambda: module.gdb_to_py('wide', wide), 1)
+    warm = timed(lambda: module.gdb_to_py('wide', wide), 20)
+    elements = timed(lambda: [ module.gdb_to_py('array[%d]' % i, array[i]) for i in range(2000) ], 5)
+    print("%-10s %16.2f %16.2f %20.2f" % (label, cold, warm, elements))
+
+if __name__ == '__main__':
+    print("%-10s %16s %16s %20s" % ("module", "5k fields cold", "5k fields warm", "2k array elements"))
+    import gdb_values
+    run(gdb_values, "current")
+    if '--reference' in sys.argv:
+        path = sys.argv[sys.argv.index('--reference') + 1]
+        run(load_source('reference_gdb_values', path), "reference")
@@ -1,12 +1,36 @@
-import os, signal, select, json, sys, errno
+import os, re, signal, select, json, sys, errno, fcntl, socket, time, heapq, itertools, subprocess
+from collections import deque
 # import prctl
-from threading import Lock, Thread
-from multiprocessing import Pipe
-from multiprocessing.connection import Listener, Client
 sys.path.insert(0, os.path.dirname(__file__))
-from protocol import ProtocolSocket, MalformedPacket
+from protocol import ProtocolSocket, MalformedPacket, available_codecs, StreamSocket, UnixListener, \
+                     MessageSocket, TcpListener, MUX_HEADER, MUX_OPEN, MUX_DATA, MUX_CLOSE
+import registry
 
 vim_tmux_pane = ''
+gdb_pid = None
+
+# Traps to vim within this many seconds of a wakeup collapse into one more
+# wakeup at its end.
+#
+TRAP_WINDOW = 0.02
+
+# A queued packet with one of these ops is dropped when a newer one with the
+# same op is queued behind it.  A client with more than MAX_QUEUED_BYTES
+# waiting is not reading and is disconnected.
+#
+SUPERSEDED_OPS = ('goto', 'watches', 'disp')
+MAX_QUEUED_BYTES = 32 << 20
+
+# Observers are sent copies of vim's packets with these ops, unless they ask
+# for others, and may only send requests with READ_ONLY_OPS, which gdb
+# serves them without side effects and only from the program's sources.
+# They may trap gdb only while the inferior is stopped, as the SIGINT would
+# stop it.  An observer that falls more than OBSERVER_QUEUED_BYTES behind
+# loses its oldest packets.
+#
+OBSERVER_EVENTS = ('batch', 'goto', 'watches', 'disp', 'place', 'unplace', 'replace')
+READ_ONLY_OPS = ('eval', 'bt', 'stats', 'source')
+OBSERVER_QUEUED_BYTES = 4 << 20
 
 def output(msg):
     print(str(msg))
@@ -19,133 +43,811 @@ def pts(msg):
     prefix = "gdb proxy: " if gdb_pid else "vim proxy: "
     open('/dev/pts/10', 'wb').write(prefix+str(msg)+'\n')
 
-class DoNotForward(Exception):
-    pass
+def set_cloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+class EventLoop(object):
+    """Single threaded readiness loop that drives every connection in the proxy.
+
+    Readers and writers are registered per file descriptor, and timers run
+    callbacks once their delay has passed.  Signal handlers wake the loop through a
+    self-pipe, so shutdown does not wait on a polling interval.
+    """
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+        self._registered = set()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._epoll = select.epoll() if hasattr(select, 'epoll') else None
+        self._running = False
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            set_cloexec(fd)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.add_reader(self._wake_r, self._drain_wakeups)
+
+    @staticmethod
+    def _fileno(obj):
+        return obj if isinstance(obj, int) else obj.fileno()
+
+    def _update(self, fd):
+        if self._epoll is None:
+            return
+        mask = (select.EPOLLIN if fd in self._readers else 0) | (select.EPOLLOUT if fd in self._writers else 0)
+        if fd in self._registered:
+            if mask:
+                self._epoll.modify(fd, mask)
+            else:
+                self._registered.discard(fd)
+                self._epoll.unregister(fd)
+        elif mask:
+            self._registered.add(fd)
+            self._epoll.register(fd, mask)
+
+    def add_reader(self, obj, callback):
+        fd = self._fileno(obj)
+        self._readers[fd] = callback
+        self._update(fd)
+
+    def remove_reader(self, obj):
+        fd = self._fileno(obj)
+        if self._readers.pop(fd, None) is not None:
+            self._update(fd)
+
+    def add_writer(self, obj, callback):
+        """Call `callback` whenever `obj` can take more output."""
+        fd = self._fileno(obj)
+        self._writers[fd] = callback
+        self._update(fd)
 
-class TimeoutException(Exception):
-    pass
+    def remove_writer(self, obj):
+        fd = self._fileno(obj)
+        if self._writers.pop(fd, None) is not None:
+            self._update(fd)
 
-def accept_timeout(server, timeout=0):
-    sock = server._listener._socket
-    while True:
+    def call_later(self, delay, callback):
+        """Run `callback` after `delay` seconds.  Returns a handle for cancel."""
+        timer = [ time.time() + delay, next(self._sequence), callback ]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    def wakeup(self):
+        """Async-signal-safe: interrupts a blocked poll."""
         try:
-            if len(select.select([sock], [sock], [sock], timeout)):
-                return server.accept()
-            break
-        except select.error as e:
-            if e[0] != errno.EINTR:
+            os.write(self._wake_w, b'x')
+        except OSError:
+            pass
+
+    def _drain_wakeups(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except OSError:
+            pass
+
+    def stop(self):
+        self._running = False
+        self.wakeup()
+
+    def _timeout(self):
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        return max(0, self._timers[0][0] - time.time())
+
+    def _poll(self, timeout):
+        """Returns the readable and the writable descriptors."""
+        try:
+            if self._epoll is not None:
+                events = self._epoll.poll(-1 if timeout is None else timeout)
+                return ([ fd for fd, mask in events if mask & ~select.EPOLLOUT ],
+                        [ fd for fd, mask in events if mask & (select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP) ])
+            return select.select(list(self._readers.keys()), list(self._writers.keys()), [], timeout)[:2]
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
                 raise
-    raise TimeoutException()
+            return [], []
 
-def AcceptLoop(server, action):
-    while True:
+    def _dispatch(self, callback):
         try:
-            conn = ProtocolSocket(accept_timeout(server, timeout=1))
+            callback()
+        except SystemExit:
+            raise
+        except:
+            import traceback
+            traceback.print_exc()
+            output("Proxy continuing...")
 
-            Thread(target=action, args=(conn,)).start()
-        except TimeoutException:
-            if g_state['shutdown']:
-                output("Shutting down proxy server accept loop")
-                break
+    def _run_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            callback = heapq.heappop(self._timers)[2]
+            if callback is not None:
+                self._dispatch(callback)
 
-def HandleProxyRequest(c):
-    global vim_tmux_pane, gdb_pid, g_state
-    if c['op'] == 'trap':
-        if c['target'] == 'gdb':
-            if gdb_pid:
-                os.kill(gdb_pid, signal.SIGINT)
-        elif c['target'] == 'vim':
-            if vim_tmux_pane:
-                os.system('tmux send-keys -t %s "\x1b\x1b:call HistPreserve(\'GdbRefresh\')" ENTER' % (vim_tmux_pane))
-        else:
-            output("Proxy trap with unknown target: " + str(c))
-        return
-    elif c['op'] == 'quit':
-        g_state['shutdown'] = True
-    elif c['op'] == 'print':
-        output(c['msg'])
-    elif c['op'] == 'tmux_pane':
-        if not vim_tmux_pane:
-            vim_tmux_pane = c['pane']
-    else:
-        output("Proxy packet with unknown op: " + str(c))
-    raise DoNotForward()
+    def run(self):
+        self._running = True
+        while self._running:
+            readable, writable = self._poll(self._timeout())
+            for fd in writable:
+                callback = self._writers.get(fd)
+                if callback is not None:
+                    self._dispatch(callback)
+            for fd in readable:
+                callback = self._readers.get(fd)
+                if callback is not None:
+                    self._dispatch(callback)
+            self._run_timers()
 
-def ProxyConnection(name, conns):
-    global gdb_pid
-    in_conn = conns[name]
-    try:
-        while True:
+class SendQueue(object):
+    """Packets waiting to be written to one connection.
+
+    They are written only as fast as the peer reads them, from a writer
+    callback on the event loop, so a client that stops reading never blocks
+    the proxy or the gdb behind it.  Transports that cannot be written to
+    without blocking are written to directly.  `on_error` is called if the
+    connection fails or more than `max_bytes` are waiting, unless
+    `drop_oldest` is set, in which case the oldest packets are dropped
+    instead.
+    """
+    def __init__(self, loop, conn, on_error, max_bytes=MAX_QUEUED_BYTES, drop_oldest=False):
+        self.loop = loop
+        self.conn = conn
+        self.on_error = on_error
+        self.max_bytes = max_bytes
+        self.drop_oldest = drop_oldest
+        self.dropped = 0
+        self.entries = deque()
+        self.offset = 0
+        self.bytes = 0
+        self.high_water = 0
+        self.sent = 0
+        self.superseded = 0
+        try:
+            self.out = socket.fromfd(conn.fileno(), socket.AF_UNIX, socket.SOCK_STREAM)
+            set_cloexec(self.out.fileno())
+        except (socket.error, OSError, ValueError):
+            self.out = None
+
+    def put(self, packet):
+        self.put_messages(self.conn.encode(packet), packet['op'])
+
+    def put_messages(self, messages, op=None):
+        data = self.conn.wire(messages) if self.out is not None else None
+        if data is None:
+            self.conn.send_messages(messages)
+            self.sent += 1
+            return
+        key = op if op in SUPERSEDED_OPS else None
+        if key is not None:
+            for i, (queued_key, queued) in enumerate(self.entries):
+                if queued_key == key and (i > 0 or self.offset == 0):
+                    del self.entries[i]
+                    self.bytes -= len(queued)
+                    self.superseded += 1
+                    break
+        self.entries.append((key, data))
+        self.bytes += len(data)
+        self.high_water = max(self.high_water, self.bytes)
+        if self.bytes > self.max_bytes and self.drop_oldest:
+            # The head may be partly written already; it has to go out whole.
+            first = 1 if self.offset else 0
+            while self.bytes > self.max_bytes and len(self.entries) > first + 1:
+                self.bytes -= len(self.entries[first][1])
+                del self.entries[first]
+                self.dropped += 1
+        elif self.bytes > self.max_bytes:
+            self.on_error("%d bytes waiting to be read" % self.bytes)
+            return
+        self.flush()
+
+    def flush(self):
+        while self.entries:
+            data = self.entries[0][1]
             try:
-                if g_state['shutdown'] or os.getppid() == 1:
-                    output("GDB has terminated.  Ending proxy connection to %s" % name)
-                    gdb_pid = None
-                    exit(0)
-                for ready in ProtocolSocket.select([in_conn], timeout=1):
-                    c = ready.recv_packet()
-                    dest_conn = None
-                    if c['dst'] == 'proxy':
-                        HandleProxyRequest(c)
-                    else:
-                        c['src'] = name
-                        try:
-                            dest_conn = conns[c['dst']]
-                        except KeyError:
-                            # Swallow packets intended for vim if no vim is
-                            # connected
-                            #
-                            if c['dst'] != "vim":
-                                output("Packet with unknown destination: " + str(c))
-
-                    if dest_conn:
-                        dest_conn.send_packet(**c)
-
-            except IOError as e:
-                output("IOError(%s)" % str(e.errno))
-                if e.errno != errno.EINTR:
+                count = self.out.send(memoryview(data)[self.offset:], socket.MSG_DONTWAIT)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
                     break
-            except EOFError:
-                output("Proxy connection to %s has ended gracefully." % name)
+                self.on_error(str(e))
+                return
+            self.offset += count
+            self.bytes -= count
+            if self.offset < len(data):
                 break
-            except MalformedPacket as e:
-                output("Malformed packet: %s" % e)
-            except SystemExit:
-                raise
-            except (select.error, DoNotForward, KeyboardInterrupt):
+            self.entries.popleft()
+            self.offset = 0
+            self.sent += 1
+        if self.entries:
+            self.loop.add_writer(self.out, self.flush)
+        else:
+            self.loop.remove_writer(self.out)
+
+    def stats(self):
+        return { 'depth': len(self.entries), 'bytes': self.bytes, 'high_water': self.high_water,
+                 'sent': self.sent, 'superseded': self.superseded, 'dropped': self.dropped }
+
+    def close(self):
+        if self.out is not None:
+            self.loop.remove_writer(self.out)
+            self.out.close()
+            self.out = None
+        self.entries.clear()
+
+def tmux_quote(s):
+    return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$')
+
+def tmux_version():
+    """(major, minor) of the tmux on the path, or None for a build that
+    does not say, which is one newer than any release."""
+    with open(os.devnull, 'w') as devnull:
+        version = subprocess.check_output([ 'tmux', '-V' ], stderr=devnull).decode('utf-8', 'replace')
+    match = re.search(r'(\d+)\.(\d+)', version)
+    return match and (int(match.group(1)), int(match.group(2)))
+
+class TmuxControl(object):
+    """A `tmux -C` client kept attached for typing into vim's pane, so that
+    a wakeup does not start a shell and a tmux client every time.
+
+    A control client is sent the output of every pane in the session, vim's
+    redraws and the inferior's output included, unless it turns that off,
+    which tmux can only do from 3.2 on.  With an older tmux this raises
+    OSError, and the caller falls back to plain send-keys."""
+    def __init__(self, loop, pane):
+        self.loop = loop
+        self.pane = pane
+        try:
+            version = tmux_version()
+        except subprocess.CalledProcessError as e:
+            raise OSError(str(e))
+        if version is not None and version < (3, 2):
+            raise OSError("tmux %d.%d cannot turn off control client output" % version)
+        with open(os.devnull, 'w') as devnull:
+            self.proc = subprocess.Popen([ 'tmux', '-C', 'attach-session', '-f', 'no-output', '-t', pane ], stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=devnull, close_fds=True)
+        for f in (self.proc.stdin, self.proc.stdout):
+            set_cloexec(f.fileno())
+        self.loop.add_reader(self.proc.stdout, self.on_output)
+
+    @property
+    def alive(self):
+        return self.proc is not None
+
+    def on_output(self):
+        # Replies to our commands are of no interest, but must be drained.
+        if not os.read(self.proc.stdout.fileno(), 65536):
+            self.close()
+
+    def command(self, keys):
+        """Run `keys` as an ex command in vim.  False if tmux has gone."""
+        if self.proc is None:
+            return False
+        pane = self.pane
+        lines = "send-keys -t %s Escape Escape\nsend-keys -t %s -l %s\nsend-keys -t %s Enter\n" % (
+            pane, pane, tmux_quote(keys), pane)
+        try:
+            os.write(self.proc.stdin.fileno(), lines.encode('utf-8'))
+        except OSError:
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        if self.proc is None:
+            return
+        self.loop.remove_reader(self.proc.stdout)
+        for f in (self.proc.stdin, self.proc.stdout):
+            try:
+                f.close()
+            except (IOError, OSError):
                 pass
-            except:
-                import traceback
-                traceback.print_exc()
-                output("Proxy continuing...")
+        # Control clients exit as soon as their input is closed.
+        self.proc.wait()
+        self.proc = None
 
-    finally:
+class Mux(object):
+    """Carries the byte streams of many connections over one `link`, as
+    frames tagged with a channel number.
+
+    Connections on this side are given a channel with open().  `on_open` is
+    asked for the connection of each channel the far side opens, and may
+    return None to refuse it.  Only one side of a link opens channels.
+    `on_close` is called once the link is lost.
+    """
+    def __init__(self, loop, link, on_open, on_close=None):
+        self.loop = loop
+        self.link = link
+        self.on_open = on_open
+        self.on_close = on_close
+        self.conns = {}
+        self.queues = {}
+        self.channel_ids = itertools.count(1)
+        self.closed = False
+        self.link_queue = SendQueue(loop, link, lambda reason: self.close(reason))
+        self.loop.add_reader(link, self.on_link_readable)
+
+    def open(self, conn):
+        channel = next(self.channel_ids)
+        self.attach(channel, conn)
+        self.send_frame(MUX_OPEN, channel)
+        return channel
+
+    def attach(self, channel, conn):
+        self.conns[channel] = conn
+        self.queues[channel] = SendQueue(self.loop, conn, lambda reason: self.close_channel(channel, reason))
+        self.loop.add_reader(conn, lambda: self.on_readable(channel, conn))
+
+    def send_frame(self, kind, channel, data=b''):
+        self.link_queue.put_messages([ MUX_HEADER.pack(kind, channel, len(data)), data ])
+
+    def on_readable(self, channel, conn):
+        try:
+            data = conn.recv_some()
+        except (IOError, OSError):
+            data = b''
+        if data:
+            self.send_frame(MUX_DATA, channel, data)
+        else:
+            self.close_channel(channel)
+
+    def close_channel(self, channel, reason=None, tell_peer=True):
+        conn = self.conns.pop(channel, None)
+        if conn is None:
+            return
+        if reason is not None:
+            output("Closing channel %d: %s" % (channel, reason))
+        self.queues.pop(channel).close()
+        self.loop.remove_reader(conn)
+        conn.close()
+        if tell_peer and not self.closed:
+            self.send_frame(MUX_CLOSE, channel)
+
+    def on_link_readable(self):
+        """Handle the frames that have arrived whole.  The rest of a frame
+        that is still arriving is left buffered for the next call."""
+        try:
+            self.link.fill()
+        except (IOError, OSError, EOFError):
+            self.close("link lost")
+            return
+        while not self.closed:
+            header = self.link.peek(MUX_HEADER.size)
+            if header is None:
+                return
+            kind, channel, size = MUX_HEADER.unpack(header)
+            if self.link.buffered() < MUX_HEADER.size + size:
+                return
+            self.link.recv_bytes(MUX_HEADER.size)
+            data = self.link.recv_bytes(size) if size else b''
+            if kind == MUX_DATA and channel in self.conns:
+                self.queues[channel].put_messages([ data ])
+            elif kind == MUX_OPEN and channel not in self.conns:
+                conn = self.on_open(channel)
+                if conn is None:
+                    self.send_frame(MUX_CLOSE, channel)
+                else:
+                    self.attach(channel, conn)
+            elif kind == MUX_CLOSE:
+                self.close_channel(channel, tell_peer=False)
+
+    def close(self, reason=None):
+        if self.closed:
+            return
+        self.closed = True
+        if reason is not None:
+            output("Closing tunnel: %s" % reason)
+        for channel in list(self.conns.keys()):
+            self.close_channel(channel, tell_peer=False)
+        self.loop.remove_reader(self.link)
+        self.link_queue.close()
+        self.link.close()
+        if self.on_close:
+            self.on_close(self)
+
+class Session(object):
+    """Routes packets between one gdb and the clients attached to its proxy.
+
+    `on_close` is called once the gdb side of the session has gone away.
+    Clients may also connect to the notify port, which the codec ack
+    advertises, to be woken by a line whenever a trap is sent to them.  A
+    `tunnel` session hands traps for vim on to the proxy at the far end, and
+    a `remote` session, whose gdb is at the far end, does the same with
+    traps for gdb.
+
+    Any number of observers may connect alongside vim by saying so in their
+    name packet.  Each gets a unique name, copies of the events vim is sent
+    and answers to its read-only requests, but cannot interrupt a running
+    inferior to have them answered sooner.
+
+    A session started by gdb on this host keeps its `registration` in the
+    registry up to date with the inferior gdb reports.
+    """
+    def __init__(self, loop, gdb_conn, managed=False, on_close=None, tunnel=False, remote=False):
+        self.loop = loop
+        self.conns = {}
+        self.queues = {}
+        self.observers = {}
+        self.observer_ids = itertools.count(1)
+        self.server = None
+        self.unix_server = None
+        self.notify_server = None
+        self.notify_conns = {}
+        self.managed = managed
+        self.tunnel = tunnel
+        self.remote = remote
+        self.gdb_running = False
+        self.tmux = None
+        self.wake_timer = None
+        self.wake_again = False
+        self.tmux_pane = vim_tmux_pane
+        self.on_close = on_close
+        self.closed = False
+        self.registration = None
+        self.attach('gdb', gdb_conn)
+
+    def attach(self, name, conn, events=None):
+        """Attach `conn` as `name`, or as an observer of `events` when
+        those are given."""
+        self.conns[name] = conn
+        on_error = lambda reason: self.on_send_error(name, reason)
+        if events is None:
+            self.queues[name] = SendQueue(self.loop, conn, on_error)
+        else:
+            self.queues[name] = SendQueue(self.loop, conn, on_error, OBSERVER_QUEUED_BYTES, drop_oldest=True)
+            self.observers[name] = set(events)
+        self.loop.add_reader(conn, lambda: self.on_readable(name, conn))
+
+    def on_send_error(self, name, reason):
+        output("Disconnecting %s: %s" % (name, reason))
+        self.detach(name)
+
+    def send(self, name, packet):
+        try:
+            self.queues[name].put(packet)
+        except (IOError, EOFError):
+            output("Lost connection to %s" % name)
+            self.detach(name)
+
+    def detach(self, name):
+        conn = self.conns.pop(name, None)
+        if conn is None:
+            return
+        self.queues.pop(name).close()
+        self.observers.pop(name, None)
+        self.loop.remove_reader(conn)
         try:
-            if gdb_pid and g_state['gdb'] == 'managed' and name in ("vim", "gdb"):
+            conn.close()
+        except (IOError, OSError):
+            pass
+        try:
+            if gdb_pid and self.managed and name in ("vim", "gdb"):
                 output("Terminating GDB.")
                 os.kill(gdb_pid, signal.SIGTERM)
-        except:
+        except OSError:
             pass
+        if name == 'gdb':
+            self.close()
+
+    def listen(self, server, unix_server=None):
+        """Accept clients on the TCP `server` and, for local clients, on the
+        Unix socket `unix_server`."""
+        self.server = server
+        self.loop.add_reader(server, lambda: self.on_accept(server))
+        if unix_server is not None:
+            self.unix_server = unix_server
+            self.loop.add_reader(unix_server, lambda: self.on_accept(unix_server))
+        self.notify_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        set_cloexec(self.notify_server.fileno())
+        self.notify_server.bind((server.address[0], 0))
+        self.notify_server.listen(5)
+        self.loop.add_reader(self.notify_server, self.on_notify_accept)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.registration is not None:
+            self.registration.remove()
+        if self.server is not None:
+            self.loop.remove_reader(self.server)
+            self.server.close()
+        if self.unix_server is not None:
+            self.loop.remove_reader(self.unix_server)
+            self.unix_server.close()
+        if self.notify_server is not None:
+            self.loop.remove_reader(self.notify_server)
+            self.notify_server.close()
+        for name in list(self.notify_conns.keys()):
+            self.drop_notify(name)
+        if self.wake_timer is not None:
+            self.loop.cancel(self.wake_timer)
+        if self.tmux is not None:
+            self.tmux.close()
+        for name in list(self.conns.keys()):
+            self.detach(name)
+        if self.on_close:
+            self.on_close(self)
+
+    def on_accept(self, server):
+        conn = ProtocolSocket(server.accept())
+        set_cloexec(conn.fileno())
+        self.loop.add_reader(conn, lambda: self.on_hello(conn))
+
+    def on_hello(self, conn):
+        try:
+            conn.fill()
+            if not conn.ready():
+                return # the rest of the name packet is still on its way
+            hello = conn.recv_op('name')
+            name = hello['name']
+            events = None
+            if hello.get('observer'):
+                name = '%s#%d' % (name, next(self.observer_ids))
+                events = hello.get('events') or OBSERVER_EVENTS
+            codec = conn.negotiate(hello.get('codecs', []))
+            notify = self.notify_server.getsockname()[1] if self.notify_server is not None else None
+            conn.send_packet(dst=name, op='codec', codec=codec, notify=notify, name=name)
+            conn.set_codec(codec)
+        except (EOFError, IOError, MalformedPacket) as e:
+            output("Failed to receive name packet: %s" % e)
+            self.loop.remove_reader(conn)
+            conn.close()
+            return
+        self.loop.remove_reader(conn)
+        if name in self.conns:
+            output("Attempt to create duplicate connection to %s" % name)
+            conn.close()
+            return
+        self.attach(name, conn, events)
+        if conn.ready():
+            self.on_readable(name, conn)
+
+    def on_notify_accept(self):
+        sock, _ = self.notify_server.accept()
+        set_cloexec(sock.fileno())
+        self.loop.add_reader(sock, lambda: self.on_notify_hello(sock))
+
+    def on_notify_hello(self, sock):
+        """The first line on a notify connection names the client."""
+        self.loop.remove_reader(sock)
+        try:
+            name = sock.recv(256).decode('utf-8').split('\n')[0].strip()
+        except (socket.error, UnicodeDecodeError):
+            name = ''
+        if not name:
+            sock.close()
+            return
+        self.drop_notify(name)
+        sock.setblocking(False)
+        self.notify_conns[name] = sock
+        self.loop.add_reader(sock, lambda: self.on_notify_readable(name, sock))
+
+    def on_notify_readable(self, name, sock):
+        try:
+            if sock.recv(4096):
+                return
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+        if self.notify_conns.get(name) is sock:
+            self.drop_notify(name)
+
+    def drop_notify(self, name):
+        sock = self.notify_conns.pop(name, None)
+        if sock is not None:
+            self.loop.remove_reader(sock)
+            sock.close()
+
+    def notify(self, name):
+        """Wake `name` through its notify connection.  Returns False when it
+        has none, so that the caller can fall back to tmux."""
+        sock = self.notify_conns.get(name)
+        if sock is None:
+            return False
+        try:
+            sock.send(b'trap\n')
+        except socket.error as e:
+            # With the buffer full, the client has wakeups waiting anyway.
+            if e.args[0] != errno.EAGAIN:
+                self.drop_notify(name)
+                return False
+        return True
+
+    def wake_vim(self):
+        """Wake vim now, unless it was woken within TRAP_WINDOW.  Traps in
+        that window are answered by a single wakeup once it has passed."""
+        if self.wake_timer is not None:
+            self.wake_again = True
+            return
+        self.poke_vim()
+        self.wake_timer = self.loop.call_later(TRAP_WINDOW, self.on_wake_timer)
+
+    def on_wake_timer(self):
+        self.wake_timer = None
+        if self.wake_again:
+            self.wake_again = False
+            self.wake_vim()
+
+    def poke_vim(self):
+        if self.notify('vim') or not self.tmux_pane:
+            return
+        command = ":call HistPreserve('GdbRefresh')"
+        if self.tmux is None:
+            try:
+                self.tmux = TmuxControl(self.loop, self.tmux_pane)
+            except OSError as e:
+                output("Could not start tmux control client: %s" % e)
+                self.tmux = False
+        if not self.tmux or not self.tmux.command(command):
+            os.system('tmux send-keys -t %s "\x1b\x1b%s" ENTER' % (self.tmux_pane, command))
+
+    def on_readable(self, name, conn):
+        """Route the packets that have arrived whole.  A client that stops
+        partway through a frame holds up no one but itself."""
+        try:
+            conn.fill()
+            while conn.ready():
+                try:
+                    c = conn.recv_packet()
+                except MalformedPacket as e:
+                    output("Malformed packet: %s" % e)
+                    continue
+                self.route(name, conn, c)
+                if self.closed or name not in self.conns:
+                    break
+        except EOFError:
+            output("Proxy connection to %s has ended gracefully." % name)
+            self.detach(name)
+        except IOError as e:
+            output("IOError(%s)" % str(e.errno))
+            if e.errno != errno.EINTR:
+                self.detach(name)
+
+    def route(self, name, conn, c):
+        if c['dst'] == 'proxy':
+            self.handle_proxy_request(name, conn, c)
+            return
+        if name in self.observers and c['op'] not in READ_ONLY_OPS:
+            output("Ignoring %s from observer %s" % (c['op'], name))
+            return
+        if name in self.observers:
+            c['observer'] = True
+        # Requests through a tunnel keep the client at the near end as their
+        # source, and the answers go back up the tunnel.
+        #
+        if not (self.tunnel and name == 'vim' and 'src' in c):
+            c['src'] = name
+        if c['dst'] == 'vim':
+            self.broadcast(c)
+        if c['dst'] not in self.conns and self.tunnel and name == 'gdb' and 'vim' in self.conns:
+            self.send('vim', c)
+            return
+        if c['dst'] not in self.conns:
+            # Swallow packets intended for vim if no vim is
+            # connected
+            #
+            if c['dst'] != "vim":
+                output("Packet with unknown destination: " + str(c))
+            return
+        self.send(c['dst'], c)
+
+    def broadcast(self, c):
+        """Copy a packet for vim to the observers subscribed to its op.  It
+        is encoded once for each codec in use, not once per observer."""
+        encoded = {}
+        for name, events in list(self.observers.items()):
+            if c['op'] not in events:
+                continue
+            queue = self.queues[name]
+            codec = queue.conn.codec
+            try:
+                if codec not in encoded:
+                    encoded[codec] = queue.conn.encode(dict(c, dst='observer'))
+                queue.put_messages(encoded[codec], c['op'])
+            except (IOError, EOFError):
+                output("Lost connection to %s" % name)
+                self.detach(name)
+                continue
+            self.notify(name)
 
-def ProxyServer(gdb_conn, address_file):
-    global vim_tmux_pane, g_state
+    def stats(self):
+        return { 'queues': dict((name, queue.stats()) for name, queue in self.queues.items()) }
+
+    def handle_proxy_request(self, name, conn, c):
+        if c['op'] == 'codec':
+            # gdb's answer to the init packet, which offered it our codecs.
+            # Clients have theirs chosen for them in the name handshake.
+            #
+            if name == 'gdb' and c['codec'] in available_codecs():
+                conn.set_codec(c['codec'])
+            else:
+                output("Ignoring codec %s from %s" % (c['codec'], name))
+        elif c['op'] == 'trap':
+            if c['target'] == 'gdb' and name in self.observers and self.gdb_running:
+                output("Not interrupting the running inferior for observer %s" % name)
+            elif c['target'] == 'gdb':
+                if self.remote:
+                    self.send('gdb', c)
+                elif gdb_pid:
+                    os.kill(gdb_pid, signal.SIGINT)
+            elif c['target'] == 'vim':
+                if self.tunnel and 'vim' in self.conns:
+                    self.send('vim', c)
+                else:
+                    self.wake_vim()
+            else:
+                output("Proxy trap with unknown target: " + str(c))
+        elif c['op'] == 'quit' and name in self.observers:
+            self.detach(name)
+        elif c['op'] == 'quit':
+            output("GDB has terminated.  Ending proxy session.")
+            self.close()
+        elif c['op'] == 'print':
+            output(c['msg'])
+        elif c['op'] == 'stats':
+            self.send(name, dict(dst=name, op='response', request_id=c.get('request_id'), stats=self.stats()))
+        elif c['op'] == 'running':
+            if name == 'gdb':
+                self.gdb_running = c['running']
+                # The proxy at the near end is the one observers talk to
+                #
+                if self.tunnel and 'vim' in self.conns:
+                    self.send('vim', c)
+        elif c['op'] == 'inferior':
+            if self.registration is not None and name == 'gdb':
+                self.registration.update(inferior_pid=c['pid'] or None)
+        elif c['op'] == 'tmux_pane':
+            if not self.tmux_pane and name not in self.observers:
+                self.tmux_pane = c['pane']
+        else:
+            output("Proxy packet with unknown op: " + str(c))
+
+def ProxyServer(loop, gdb_conn, address_file, on_close=None, remote=False):
     try:
-        if 'EXTERMINATOR_TUNNEL' in os.environ:
-            # Remote side of an SSH connection
+        if 'EXTERMINATOR_TUNNEL' in os.environ and not remote:
+            # Remote side of an SSH connection, reached through the tunnel's
+            # Unix socket or, from older launchers, a forwarded port
             #
-            port = int(os.environ['EXTERMINATOR_TUNNEL'])
-            host = '127.0.0.1'
-            vim_conn = ProtocolSocket(Client((host, port)))
-            conns = { 'vim': vim_conn, 'gdb': gdb_conn }
-            Thread(target=ProxyConnection, args=('vim', conns)).start()
-            Thread(target=ProxyConnection, args=('gdb', conns)).start()
+            tunnel = os.environ['EXTERMINATOR_TUNNEL']
+            if tunnel.isdigit():
+                vim_conn = ProtocolSocket(MessageSocket.connect(('127.0.0.1', int(tunnel))))
+            else:
+                vim_conn = ProtocolSocket(StreamSocket.connect_unix(tunnel))
+            set_cloexec(vim_conn.fileno())
+            hello = vim_conn.recv_op('init')
+            codec = vim_conn.negotiate(hello.get('codecs', []))
+            vim_conn.send_packet(dst='proxy', op='codec', codec=codec)
+            vim_conn.set_codec(codec)
+            # gdb waits for an init packet as well.  It gets the one from the
+            # far end, offering it the codecs of this side.
+            #
+            gdb_conn.send_packet(**dict(hello, codecs=available_codecs()))
+            session = Session(loop, gdb_conn, on_close=on_close, tunnel=True)
+            session.attach('vim', vim_conn)
         else:
             try:
-                server = Listener(('localhost', 0))
+                server = TcpListener(('localhost', 0))
+                set_cloexec(server.fileno())
+                try:
+                    unix_server = UnixListener()
+                    set_cloexec(unix_server.fileno())
+                except socket.error:
+                    unix_server = None # no abstract namespace outside of Linux
                 if address_file:
-                    g_state['gdb'] = 'managed'
-                    open(address_file, 'w').write(json.dumps(server.address))
+                    address = { 'host': server.address[0], 'port': server.address[1] }
+                    if unix_server is not None:
+                        address['unix'] = unix_server.address
+                    open(address_file, 'w').write(json.dumps(address))
                 else:
                     output("Proxy server is running on %s:%d" % server.address)
+                    if unix_server is not None:
+                        output("and on %s" % unix_server.address)
                     command = 'GdbConnect %s:%d' % server.address
                     if 'DISPLAY' in os.environ:
                         output("Connect in vim using '%s' (in selection buffer)" % command)
@@ -154,7 +856,8 @@ def ProxyServer(gdb_conn, address_file):
                         output("Connect in vim using '%s'" % command)
                 if vim_tmux_pane:
                     os.system('tmux send-keys -t %s "\x1b\x1b:call HistPreserve(\'GdbConnect\')" ENTER' % (vim_tmux_pane))
-                gdb_conn.send_packet(dst='gdb', op='init', port=server.address[1], host=server.address[0])
+                gdb_conn.send_packet(dst='gdb', op='init', port=server.address[1], host=server.address[0],
+                                     codecs=available_codecs())
             except:
                 output("Error occurred during proxy server initialization")
                 import traceback
@@ -162,27 +865,16 @@ def ProxyServer(gdb_conn, address_file):
                 output("Aborting proxy")
                 return
 
-            conns = { 'gdb': gdb_conn }
-            Thread(target=ProxyConnection, args=('gdb', conns)).start()
-
-            conns_lock = Lock()
-
-            def _Thread(conn):
+            session = Session(loop, gdb_conn, managed=bool(address_file), on_close=on_close, remote=remote)
+            session.listen(server, unix_server)
+            if gdb_pid:
                 try:
-                    name = conn.recv_op('name')['name']
-                    with conns_lock:
-                        if name in conns:
-                            output("Attempt to create duplicate connection to %s" % name)
-                            return
-                        conns[name] = conn
-                    ProxyConnection(name, conns)
-                except (EOFError, IOError, MalformedPacket) as e:
-                    output("Failed to receive name packet: %s" % e)
-                    return
-                finally:
-                    conn.close()
-
-            AcceptLoop(server, _Thread)
+                    session.registration = registry.Registration(gdb_pid=gdb_pid, host=server.address[0],
+                                                                 port=server.address[1],
+                                                                 unix=unix_server and unix_server.address)
+                except (IOError, OSError) as e:
+                    output("Not registering the session: %s" % e)
+        return session
 
     except SystemExit:
         raise
@@ -197,26 +889,96 @@ def ProxyServer(gdb_conn, address_file):
             pass
         raise
 
-def RunServer():
-    server = Listener(('localhost', int(os.environ['EXTERMINATOR_SERVER'])))
+def RunServer(loop):
+    """Local side of an SSH connection.  EXTERMINATOR_SERVER is the path of
+    a Unix socket whose every connection is a tunnel carrying any number of
+    remote gdbs, or a port whose every connection is one remote gdb."""
+    address = os.environ['EXTERMINATOR_SERVER']
+    if address.isdigit():
+        server = TcpListener(('localhost', int(address)))
+        set_cloexec(server.fileno())
+
+        def _accept():
+            conn = ProtocolSocket(server.accept())
+            set_cloexec(conn.fileno())
+            ProxyServer(loop, conn, None, remote=True)
+
+        loop.add_reader(server, _accept)
+        loop.run()
+        return
+
+    # Each channel of a tunnel is joined to a session of its own through a
+    # socket pair, as gdb is to its proxy.
+    #
+    server = UnixListener(address)
+    set_cloexec(server.fileno())
+
+    def _open(channel):
+        ends = [ StreamSocket(sock) for sock in socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM) ]
+        for end in ends:
+            set_cloexec(end.fileno())
+        if ProxyServer(loop, ProtocolSocket(ends[0]), None, remote=True) is None:
+            ends[0].close()
+        return ends[1]
+
+    def _accept_link():
+        link = server.accept()
+        set_cloexec(link.fileno())
+        Mux(loop, link, _open)
+
+    loop.add_reader(server, _accept_link)
+    try:
+        loop.run()
+    finally:
+        server.close()
 
-    def _ServerThread(conn):
+def RunMux(loop):
+    """Remote side of an SSH connection.  Carries the proxy of every gdb on
+    this host, which connects to EXTERMINATOR_TUNNEL, through the one
+    forwarded socket at EXTERMINATOR_MUX."""
+    path = os.environ['EXTERMINATOR_MUX']
+    # ssh may still be setting the forward up.
+    #
+    for attempt in range(50):
         try:
-            ProxyServer(conn, None)
-        except SystemExit:
-            pass
+            link = StreamSocket.connect_unix(path)
+            break
+        except socket.error:
+            time.sleep(0.1)
+    else:
+        output("No tunnel at %s" % path)
+        return
+    set_cloexec(link.fileno())
+    # The forward is only ever used once.
+    #
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+    server = UnixListener(os.environ['EXTERMINATOR_TUNNEL'])
+    set_cloexec(server.fileno())
+    mux = Mux(loop, link, lambda channel: None, on_close=lambda mux: loop.stop())
+
+    def _accept():
+        conn = server.accept()
+        set_cloexec(conn.fileno())
+        mux.open(conn)
 
-    AcceptLoop(server, _ServerThread)
+    loop.add_reader(server, _accept)
+    try:
+        loop.run()
+    finally:
+        server.close()
 
 if __name__ == '__main__':
     exterminator_file = None
     vim_tmux_pane = None
     gdb_pid = None
 
-    g_state = { 'shutdown': False, 'gdb': 'superior' }
+    loop = EventLoop()
     def _sighup_handler(signum, frame):
-        global g_state
-        g_state['shutdown'] = True
+        loop.stop()
     signal.signal(signal.SIGHUP, _sighup_handler)
 
     if 'EXTERMINATOR_FILE' in os.environ:
@@ -224,19 +986,33 @@ if __name__ == '__main__':
     if 'VIM_TMUX_PANE' in os.environ:
         vim_tmux_pane = os.environ['VIM_TMUX_PANE']
 
+    if 'EXTERMINATOR_MUX' in os.environ:
+        try:
+            RunMux(loop)
+        finally:
+            exit(0)
+
     if 'EXTERMINATOR_SERVER' in os.environ:
         # Local side of an SSH connection
         #
         try:
-            RunServer()
+            RunServer(loop)
         finally:
             exit(0)
 
     gdb_pid = os.getpid()
-    gdb_sock, gdb_proxy = Pipe(True)
+    # gdb talks to its proxy over a Unix socket pair
+    #
+    gdb_sock, gdb_proxy = [ StreamSocket(sock) for sock in socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM) ]
+    # Neither end may leak into the inferior, or the proxy would never see
+    # gdb hang up.
+    #
+    set_cloexec(gdb_sock.fileno())
+    set_cloexec(gdb_proxy.fileno())
 
     if os.fork() == 0:
         try:
+            gdb_sock.close()
             import ctypes
 
             # libc = ctypes.cdll.LoadLibrary("libc.so.6")
@@ -245,10 +1021,21 @@ if __name__ == '__main__':
             # buff.value = name
             # libc.prctl(15, ctypes.byref(buff), 0, 0, 0)
 
-            ProxyServer(ProtocolSocket(gdb_proxy), exterminator_file)
+            # PR_SET_PDEATHSIG: hang up when gdb dies, whatever else is
+            # still holding the pipe open.
+            #
+            try:
+                ctypes.CDLL(None).prctl(1, signal.SIGHUP, 0, 0, 0)
+            except (OSError, AttributeError):
+                pass
+
+            if ProxyServer(loop, ProtocolSocket(gdb_proxy), exterminator_file,
+                           on_close=lambda session: loop.stop()) is not None:
+                loop.run()
         finally:
             exit(0)
     else:
+        gdb_proxy.close()
         from gdb_exterminator import Gdb
         try:
             gdb_manager = Gdb(ProtocolSocket(gdb_sock))
@@ -256,4 +1043,3 @@ if __name__ == '__main__':
             pass
         else:
             gdb_manager.attach_hooks()
-
@@ -1,11 +1,73 @@
-import os, sys
+"""
+Runs gdb commands in a running exterminator session.
+
+    gdb_exec.py [-t timeout] port command
+    gdb_exec.py [-t timeout] port -            # commands from stdin
+    gdb_exec.py [-t timeout] port -f script
+
+The session may be named by the pid of its gdb, inferior or proxy with
+`-p pid` instead of a port, and is then found in the registry.
+A single command's output is printed as gdb would print it.  Commands from
+stdin or a script share one connection, and each result is printed as a
+line of JSON with the command, its output and its error (or null).
+Commands that are already waiting are sent together, behind one trap.
+"""
+import os, sys, json, select, getopt
 from vim_exterminator import RemoteGdb
+import registry
 
-if __name__ == '__main__':
-    port = int(sys.argv[1])
-    cmd = sys.argv[2]
+BATCH = 64
 
-    print("'%s'" % cmd)
-    gdb = RemoteGdb(None, '127.0.0.1', int(port), name="cmd" + str(os.getpid()))
-    gdb.send_exec(cmd)
+def read_batches(f):
+    """Yield the commands in `f` in lists of those that can be read without
+    waiting, skipping blank lines and comments."""
+    batch = []
+    for line in iter(f.readline, ''):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            batch.append(line)
+        if len(batch) >= BATCH or (batch and not select.select([ f ], [], [], 0)[0]):
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def result(response):
+    if 'comm' not in response:
+        # Timed out or lost the connection
+        #
+        return None, ", ".join(response.get('contents', {})) or "No response"
+    return response['output'], response['error']
+
+if __name__ == '__main__':
+    opts, args = getopt.gnu_getopt(sys.argv[1:], 't:f:p:')
+    opts = dict(opts)
+    timeout = float(opts.get('-t', 60))
+    name = "cmd" + str(os.getpid())
 
+    if '-p' in opts:
+        entry = registry.lookup(int(opts['-p']))
+        if entry is None:
+            sys.stderr.write("No exterminator session for process %s\n" % opts['-p'])
+            sys.exit(1)
+        gdb = RemoteGdb(None, entry['host'], entry['port'], name=name, timeout=timeout, path=entry.get('unix'))
+    else:
+        gdb = RemoteGdb(None, '127.0.0.1', int(args.pop(0)), name=name, timeout=timeout)
+    failed = False
+    if '-f' in opts or args == [ '-' ]:
+        f = open(opts['-f']) if '-f' in opts else sys.stdin
+        for batch in read_batches(f):
+            for comm, response in zip(batch, gdb.exec_many(batch)):
+                output, error = result(response)
+                failed = failed or error is not None
+                sys.stdout.write(json.dumps({ 'command': comm, 'output': output, 'error': error }) + "\n")
+                sys.stdout.flush()
+    else:
+        output, error = result(next(gdb.exec_many([ args[0] ])))
+        if error is not None:
+            sys.stderr.write(error + "\n")
+            failed = True
+        else:
+            sys.stdout.write(output)
+    gdb.quit(terminate_proxy=False)
+    sys.exit(1 if failed else 0)
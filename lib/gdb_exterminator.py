@@ -1,11 +1,170 @@
 import os
 import gdb
+import base64
+import hashlib
 import signal
 import atexit
+from collections import OrderedDict
 from pysigset_exterminator import suspended_signals
 from protocol import MalformedPacket
 
-from gdb_values import gdb_to_py, locals_to_py
+import gdb_values
+from gdb_values import gdb_to_py, gdb_to_py_chunks, locals_to_py, locals_by_name, parse_window, window_to_py, has_side_effects, Budget
+
+class ValueCache(object):
+    """Rendered eval responses for the current stop, least recently used
+    first.  Everything is dropped whenever the inferior may have changed.
+
+    Values are (rendered, partial) pairs.  Partial ones are not kept, as a
+    request with a larger budget would get more of the value."""
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        self.generation += 1
+        self.entries.clear()
+
+    def get(self, key, compute):
+        key = (self.generation, key)
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            value = compute()
+            if value[1]:
+                return value
+        else:
+            self.hits += 1
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        return { 'generation': self.generation, 'entries': len(self.entries), 'size': self.size,
+                 'hits': self.hits, 'misses': self.misses }
+
+class BreakpointIndex(object):
+    """Breakpoint locations by number and by (filename, line), kept current
+    from gdb's breakpoint events.
+
+    Locations are resolved once per breakpoint and only again when its
+    location string changes, it was still pending or a new objfile may have
+    added locations to it.  Every (filename, line) whose breakpoints changed
+    is collected in `dirty` until the signs are next updated.
+    """
+    def __init__(self, locate):
+        self.locate = locate
+        self.by_number = {}
+        self.by_location = {}
+        self.dirty = set()
+        self.stale = False
+
+    def add(self, breakpoint, resolve=False):
+        old = self.by_number.get(breakpoint.number)
+        if old is not None and old[1] == breakpoint.location and old[2] and not resolve:
+            locations = old[2]
+        else:
+            locations = self.locate(breakpoint)
+        self.remove(breakpoint.number)
+        self.by_number[breakpoint.number] = (breakpoint, breakpoint.location, locations, breakpoint.enabled)
+        for location in locations:
+            self.by_location.setdefault(location, set()).add(breakpoint.number)
+        self.dirty.update(locations)
+
+    def remove(self, number):
+        entry = self.by_number.pop(number, None)
+        if entry is None:
+            return
+        for location in entry[2]:
+            numbers = self.by_location[location]
+            numbers.discard(number)
+            if not numbers:
+                del self.by_location[location]
+        self.dirty.update(entry[2])
+
+    def rebuild(self, breakpoints):
+        for number in set(self.by_number.keys()) - set(b.number for b in breakpoints):
+            self.remove(number)
+        for breakpoint in breakpoints:
+            self.add(breakpoint)
+
+    def invalidate(self):
+        """Resolve every breakpoint again before the signs are next updated.
+        A new objfile can add locations to breakpoints that already had some,
+        as `break foo` does when a library defining foo is loaded.  Many
+        objfiles load between two prompts, and they are resolved once for
+        all of them."""
+        self.stale = True
+
+    def at(self, location):
+        return [ self.by_number[number][0] for number in self.by_location.get(location, ()) ]
+
+    def enabled_at(self, location):
+        return any(self.by_number[number][3] for number in self.by_location.get(location, ()))
+
+    def take_dirty(self):
+        if self.stale:
+            self.stale = False
+            for breakpoint, _, _, _ in list(self.by_number.values()):
+                if breakpoint.is_valid():
+                    self.add(breakpoint, resolve=True)
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+def frame_args(frame):
+    """The arguments of `frame` as gdb's backtrace shows them by default,
+    with structures and arrays elided."""
+    try:
+        block = frame.block()
+    except RuntimeError:
+        return ""
+    while block is not None and block.function is None:
+        block = block.superblock
+    if block is None:
+        return ""
+    args = []
+    for symbol in block:
+        if not symbol.is_argument:
+            continue
+        try:
+            value = symbol.value(frame)
+            t = value.type.strip_typedefs()
+            if t.code == gdb.TYPE_CODE_REF:
+                t = t.target().strip_typedefs()
+            if t.code in (gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION, gdb.TYPE_CODE_ARRAY):
+                text = "..."
+            else:
+                text = str(value)
+        except (gdb.error, RuntimeError):
+            text = "<error>"
+        args.append("%s=%s" % (symbol.name, text))
+    return ", ".join(args)
+
+class Backtrace(object):
+    """The frames of the selected thread, described as far from the newest
+    as they have been asked for.  Good until the inferior next runs."""
+    def __init__(self, describe):
+        self.describe = describe
+        self.frames = []
+        try:
+            self.next = gdb.newest_frame()
+        except gdb.error:
+            self.next = None # no stack
+
+    def page(self, start, count=None):
+        """Up to `count` frames from level `start`, and whether there are
+        more after them."""
+        stop = None if count is None else start + count
+        while self.next is not None and (stop is None or len(self.frames) <= stop):
+            self.frames.append(self.describe(self.next))
+            self.next = self.next.older()
+        more = stop is not None and len(self.frames) > stop
+        return self.frames[start:stop], more
 
 class Gdb(object):
     def __init__(self, sock):
@@ -13,11 +172,26 @@ class Gdb(object):
         self.next_breakpoint = 2
 
         self.breakpoints = { }
+        self.index = BreakpointIndex(self.get_locations)
+        self.index.rebuild(gdb.breakpoints() or [])
+        self.events = all(hasattr(gdb.events, 'breakpoint_' + name) for name in ('created', 'modified', 'deleted'))
+        self.marked_pc = None
         self.filename = None
         self.line = None
         self.refresh_expr = False
-        self.expr = None
+        self.watches = []
         self.last_frame = None
+        self.values = ValueCache()
+        self.budget = { 'nodes': 5000, 'size': 1 << 20, 'seconds': 1.0 }
+        self.locals_token = 0
+        self.locals_sent = {}
+        self.batch = []
+        self.inferior_pid = None
+        self.running = False
+        self.substitutions = []
+        self.sources = {}
+        self.source_files = set()
+        self.backtraces = {}
 
         try:
             hello = self.sock.recv_op('init')
@@ -26,6 +200,9 @@ class Gdb(object):
             raise
         if 'error' in hello:
             raise IOError()
+        codec = self.sock.negotiate(hello.get('codecs', []))
+        self.sock.send_packet(dst='proxy', op='codec', codec=codec)
+        self.sock.set_codec(codec)
 
         gdb.execute("set pagination off")
         gdb.execute("set print pretty on")
@@ -35,10 +212,13 @@ class Gdb(object):
         def on_prompt(prompt):
             with suspended_signals(signal.SIGINT):
                 try:
+                    self.report_running(False)
                     self.handle_events()
+                    self.report_inferior()
                     self.goto_selected_frame()
                     self.mark_breakpoints()
-                    self.send_expr()
+                    self.flush_batch()
+                    self.send_watches()
                 except (IOError, EOFError):
                     print("Connection to VIM reset by peer.  Continuing as normal GDB session.")
                     self.detach_hooks()
@@ -55,9 +235,14 @@ class Gdb(object):
             with suspended_signals(signal.SIGINT):
                 try:
                     print('cont')
+                    self.report_running(True)
+                    self.values.invalidate()
+                    self.backtraces.clear()
+                    gdb_values.invalidate_walks()
                     self.refresh_expr = True
                     self.filename, self.line = None, None
                     self.mark_breakpoints()
+                    self.flush_batch()
                 except (IOError, EOFError):
                     print("Connection to VIM reset by peer.  Continuing as normal GDB session.")
                     self.detach_hooks()
@@ -67,6 +252,31 @@ class Gdb(object):
                     traceback.print_exc()
         gdb.events.cont.connect(on_cont)
 
+        # Writes from the gdb console change what an expression evaluates to
+        # without the inferior running, and a new objfile can redefine types.
+        #
+        def on_changed(event):
+            self.values.invalidate()
+            self.backtraces.clear()
+            gdb_values.invalidate_walks()
+            self.refresh_expr = True
+        for name in ('memory_changed', 'register_changed'):
+            if hasattr(gdb.events, name):
+                getattr(gdb.events, name).connect(on_changed)
+
+        def on_new_objfile(event):
+            gdb_values.invalidate_types()
+            gdb_values.invalidate_walks()
+            self.values.invalidate()
+            self.backtraces.clear()
+            self.index.invalidate()
+        gdb.events.new_objfile.connect(on_new_objfile)
+
+        if self.events:
+            gdb.events.breakpoint_created.connect(self.index.add)
+            gdb.events.breakpoint_modified.connect(self.index.add)
+            gdb.events.breakpoint_deleted.connect(lambda breakpoint: self.index.remove(breakpoint.number))
+
         def on_exit():
             with suspended_signals(signal.SIGINT):
                 self.vim(op='quit', dst='proxy')
@@ -80,6 +290,28 @@ class Gdb(object):
         p = dict({'dst': 'vim'}, **kwargs)
         self.sock.send_packet(**p)
 
+    def flush_batch(self):
+        """Send the sign and goto operations queued since the last prompt as
+        one packet."""
+        if self.batch:
+            ops, self.batch = self.batch, []
+            self.vim(op='batch', ops=ops)
+
+    def report_inferior(self):
+        """Tell the proxy which process is being debugged, for the session
+        registry."""
+        pid = gdb.selected_inferior().pid
+        if pid != self.inferior_pid:
+            self.inferior_pid = pid
+            self.vim(op='inferior', pid=pid, dst='proxy')
+
+    def report_running(self, running):
+        """Tell the proxy whether the inferior is running, so that it does
+        not let observers interrupt it."""
+        if running != self.running:
+            self.running = running
+            self.vim(op='running', running=running, dst='proxy')
+
     def signal(self):
         self.vim(op='trap', target='vim', dst='proxy')
 
@@ -97,11 +329,19 @@ class Gdb(object):
             if c['dst'] != 'gdb':
                 continue
             if c['op'] == 'exec':
+                # With `capture` the command's output is sent back to the
+                # client instead of being written to the console.
+                #
+                output, error = None, None
                 try:
                     print(c['comm'])
-                    gdb.execute(c['comm'])
+                    output = gdb.execute(c['comm'], to_string=bool(c.get('capture')))
                 except gdb.error as e:
-                    print(str(e))
+                    error = str(e)
+                    print(error)
+                if c.get('capture'):
+                    self.vim(op='response', request_id=c['request_id'], comm=c['comm'], output=output or "",
+                             error=error, dst=c['src'])
             elif c['op'] == 'go':
                 try:
                     if gdb.selected_inferior().pid == 0:
@@ -112,39 +352,32 @@ class Gdb(object):
                         gdb.execute('c')
                 except gdb.error as e:
                     print(str(e))
+            elif c['op'] == 'eval' and c.get('observer') and has_side_effects(c['expr']):
+                self.vim(op='response', request_id=c['request_id'], expr=c['expr'], partial=False, dst=c['src'],
+                         contents={ "Observers may not assign or call functions": {} })
+            elif c['op'] == 'eval' and c['expr'] == 'auto' and c.get('delta'):
+                self.send_locals(c)
             elif c['op'] == 'eval':
-                if c['expr'] == 'auto':
-                    print('info locals')
-                    contents = { 'locals': locals_to_py() }
-                else:
-                    print('eval ' + c['expr'])
-                    try:
-                        value = gdb.parse_and_eval(c['expr'])
-
-                    except gdb.error as e:
-                        contents = { c['expr']: { str(e): {} } }
-
-                    else:
-                        contents = gdb_to_py(c['expr'], value)
-
+                streamed = []
+                render = lambda: self.evaluate(c['expr'])
+                if c.get('stream') and c['expr'] != 'auto' and parse_window(c['expr']) is None:
+                    render = lambda: self.stream(c, streamed)
+                contents, partial = self.values.get((self.frame_key(), c['expr']), lambda: self.budgeted(c, render))
                 if len(contents) == 1:
                     c['expr'], contents = list(contents.items())[0]
-                self.vim(op='response', request_id=c['request_id'], expr=c['expr'], contents=contents, dst=c['src'])
+                if streamed:
+                    contents = {}
+                self.vim(op='response', request_id=c['request_id'], expr=c['expr'], contents=contents, partial=partial,
+                         streamed=bool(streamed), dst=c['src'])
+            elif c['op'] == 'bt' and c.get('threads'):
+                print('thread apply all bt')
+                groups = self.thread_groups(c.get('count') or 64)
+                self.vim(op='response', request_id=c['request_id'], groups=groups, dst=c['src'])
             elif c['op'] == 'bt':
                 print('bt')
-                bt = []
-                frame = gdb.newest_frame()
-                while frame is not None:
-                    filename, line = self.to_loc(frame.find_sal())
-                    if filename is None or line is None:
-                        filename = ""
-                        line = 0
-                        name = "Unknown"
-                    else:
-                        name = frame.name()
-                    bt.append((filename, line, name))
-                    frame = frame.older()
-                self.vim(op='response', request_id=c['request_id'], bt=bt, dst=c['src'])
+                start = c.get('start', 0)
+                bt, more = self.backtrace(c.get('args', False)).page(start, c.get('count'))
+                self.vim(op='response', request_id=c['request_id'], bt=bt, start=start, more=more, dst=c['src'])
             elif c['op'] == 'disable':
                 self.disable_breakpoints(*c['loc'])
             elif c['op'] == 'toggle':
@@ -152,11 +385,122 @@ class Gdb(object):
             elif c['op'] == 'until':
                 self.continue_until(*c['loc'])
             elif c['op'] == 'track':
-                self.expr = c['expr']
+                # The single expression of older clients, which replaces the
+                # whole watch list.
+                #
+                self.watches = [ c['expr'] ] if c['expr'] is not None else []
+                self.refresh_expr = True
+            elif c['op'] == 'watch':
+                if c['expr'] not in self.watches:
+                    self.watches.append(c['expr'])
+                self.refresh_expr = True
+            elif c['op'] == 'unwatch':
+                if c.get('expr') is None:
+                    self.watches = []
+                elif c['expr'] in self.watches:
+                    self.watches.remove(c['expr'])
+                self.refresh_expr = True
+            elif c['op'] == 'stats':
+                self.vim(op='response', request_id=c['request_id'], stats=self.stats(), dst=c['src'])
+            elif c['op'] == 'source':
+                if c.get('observer') and c['filename'] not in self.source_files:
+                    response = { 'error': "Not a source file of the program: %s" % c['filename'] }
+                else:
+                    response = self.read_source(c['filename'], c.get('hash'))
+                self.vim(op='response', request_id=c['request_id'], filename=c['filename'], dst=c['src'], **response)
+            elif c['op'] == 'substitute':
+                self.substitutions = [ (old, new) for old, new in c['rules'] ]
             elif c['op'] == 'quit':
                 gdb.execute('quit')
 
-    def send_expr(self):
+    def send_locals(self, c):
+        """Answer a locals request with only the variables whose rendering
+        changed since the last answer the client has seen (`since`), or with
+        all of them when there is no such answer."""
+        variables, partial = self.cached_locals(c)
+        response = dict(op='response', request_id=c['request_id'], expr='locals', partial=partial, dst=c['src'])
+        response.update(self.locals_delta(c['src'], c.get('since'), variables))
+        self.vim(**response)
+
+    def cached_locals(self, c):
+        def _locals():
+            print('info locals')
+            return locals_by_name()
+        return self.values.get((self.frame_key(), 'auto-vars'), lambda: self.budgeted(c, _locals))
+
+    def locals_delta(self, client, since, variables):
+        """The locals for `client` under a new token, as the variables that
+        changed since the ones it was sent under token `since`, or all of them
+        when those are not the last it was sent."""
+        token, previous = self.locals_sent.get(client, (None, None))
+        self.locals_token += 1
+        if previous is not None and since == token:
+            delta = dict(changed={ var: rendered for var, rendered in variables.items() if previous.get(var) != rendered },
+                         removed=[ var for var in previous if var not in variables ])
+        else:
+            delta = dict(variables=variables)
+        self.locals_sent[client] = (self.locals_token, variables)
+        return dict(delta, token=self.locals_token)
+
+    def stream(self, c, streamed):
+        """Evaluate as `evaluate` does, sending the top level of the result
+        to the client in response_chunk packets while it renders.  The labels
+        that were sent are added to `streamed`."""
+        print('eval ' + c['expr'])
+        try:
+            value = gdb.parse_and_eval(c['expr'])
+        except gdb.error as e:
+            return { c['expr']: { str(e): {} } }
+        contents = {}
+        for label, chunk in gdb_to_py_chunks(c['expr'], value, c['stream']):
+            if not isinstance(chunk, dict):
+                contents[label] = chunk
+                continue
+            self.vim(op='response_chunk', request_id=c['request_id'], expr=label, contents=chunk, dst=c['src'])
+            streamed.append(label)
+            contents.setdefault(label, {}).update(chunk)
+        return contents
+
+    def budgeted(self, c, render):
+        """Render within the request's budget, falling back to ours for any
+        limit it does not set.  Returns the result and whether it is partial,
+        in which case the unexpanded parts are left as continuations."""
+        limits = dict(self.budget, **dict((str(k), v) for k, v in c.get('budget', {}).items()))
+        with Budget(**limits) as budget:
+            result = render()
+        return result, budget.partial
+
+    def frame_key(self):
+        try:
+            return str(gdb.selected_frame())
+        except gdb.error:
+            return None
+
+    def evaluate(self, expr):
+        if expr == 'auto':
+            print('info locals')
+            return { 'locals': locals_to_py() }
+        print('eval ' + expr)
+        window = parse_window(expr)
+        try:
+            value = gdb.parse_and_eval(expr if window is None else window[0])
+
+        except gdb.error as e:
+            return { expr: { str(e): {} } }
+
+        else:
+            if window is not None:
+                base, start, stop = window
+                return window_to_py(expr, base, value, start, stop)
+            return gdb_to_py(expr, value)
+
+    def stats(self):
+        return { 'values': self.values.stats() }
+
+    def send_watches(self):
+        """Evaluate every watch in one pass and push the values to vim in one
+        packet, after the inferior has run, the frame has changed or the list
+        has.  Values come from and go into the cache evals are served from."""
         try:
             if self.last_frame != gdb.selected_frame():
                 print('new frame')
@@ -165,9 +509,22 @@ class Gdb(object):
         except:
             pass
 
-        if self.expr is not None and self.refresh_expr:
+        if self.watches and self.refresh_expr:
             self.refresh_expr = False
-            self.vim(op='refresh', expr=self.expr)
+            frame = self.frame_key()
+            values = []
+            for expr in self.watches:
+                if expr == 'auto':
+                    # Pushed to vim as send_locals would answer it, taking
+                    # the last locals vim was sent as the base.
+                    #
+                    variables, partial = self.cached_locals({})
+                    since = self.locals_sent.get('vim', (None, None))[0]
+                    values.append(dict(self.locals_delta('vim', since, variables), expr=expr, since=since, partial=partial))
+                    continue
+                contents, partial = self.values.get((frame, expr), lambda: self.budgeted({}, lambda: self.evaluate(expr)))
+                values.append(dict(expr=expr, contents=contents, partial=partial))
+            self.vim(op='watches', values=values)
 
     def goto_selected_frame(self):
         try:
@@ -181,18 +538,120 @@ class Gdb(object):
         assert((filename is None) == (line is None))
         if filename is None:
             return
-        if not os.path.exists(filename):
-            return
         if filename == self.filename and line == self.line:
             return
         self.filename = filename
         self.line = line
-        self.vim(op='place', num=2, name='dummy', line=line, filename=filename)
-        self.vim(op='goto', line=line, filename=filename)
+        self.batch.append(dict(op='place', num=2, name='dummy', line=line, filename=filename))
+        self.batch.append(dict(op='goto', line=line, filename=filename))
+
+    def describe_frame(self, frame, args=False):
+        """(filename, line, function, arguments) of `frame`, the arguments
+        only if `args` is set."""
+        filename, line = self.to_loc(frame.find_sal())
+        if filename is None or line is None:
+            filename, line = "", 0
+        return (filename, line, frame.name() or "Unknown", frame_args(frame) if args else "")
+
+    def backtrace(self, args=False):
+        """The selected thread's Backtrace for this stop."""
+        thread = gdb.selected_thread()
+        key = (thread and thread.num, args)
+        if key not in self.backtraces:
+            self.backtraces[key] = Backtrace(lambda frame: self.describe_frame(frame, args))
+        return self.backtraces[key]
+
+    def thread_groups(self, depth):
+        """The stacks of every thread to `depth` frames, with the threads
+        that share one, largest group first.  Each distinct stack is only
+        described once."""
+        key = ('threads', depth)
+        if key in self.backtraces:
+            return self.backtraces[key]
+        selected = gdb.selected_thread()
+        try:
+            selected_frame = gdb.selected_frame()
+        except gdb.error:
+            selected_frame = None
+        groups = OrderedDict()
+        try:
+            for thread in gdb.selected_inferior().threads():
+                thread.switch()
+                pcs = []
+                try:
+                    frame = gdb.newest_frame()
+                except gdb.error:
+                    frame = None
+                while frame is not None and len(pcs) < depth:
+                    pcs.append(frame.pc())
+                    frame = frame.older()
+                stack = (tuple(pcs), frame is not None)
+                if stack not in groups:
+                    # Frames do not survive switching threads, so the stack
+                    # is described while its thread is selected.
+                    #
+                    frames, more = Backtrace(self.describe_frame).page(0, depth)
+                    groups[stack] = { 'threads': [], 'frames': frames, 'more': more }
+                groups[stack]['threads'].append(thread.num)
+        finally:
+            # Switching threads selects their newest frame, so the user's
+            # frame has to be selected again as well.
+            #
+            if selected is not None and selected.is_valid():
+                selected.switch()
+                if selected_frame is not None and selected_frame.is_valid():
+                    selected_frame.select()
+        for group in groups.values():
+            group['threads'].sort()
+        self.backtraces[key] = sorted(groups.values(), key=lambda group: -len(group['threads']))
+        return self.backtraces[key]
+
+    def resolve_source(self, filename):
+        """Where `filename` is on this host, trying it as it is and then as
+        rewritten by each substitution rule that applies."""
+        candidates = [ filename ] + [ new + filename[len(old):] for old, new in self.substitutions
+                                      if filename.startswith(old) and filename[len(old):len(old) + 1] in ('', '/') ]
+        for path in candidates:
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def read_source(self, filename, known=None):
+        """The contents and hash of `filename`, or only `unchanged` if the
+        client already has the version whose hash is `known`.  Files are not
+        read again while their size and mtime stay the same."""
+        path = self.resolve_source(filename)
+        if path is None:
+            return { 'error': "No such file: %s" % filename }
+        try:
+            st = os.stat(path)
+            stamp = (st.st_mtime, st.st_size)
+            cached = self.sources.get(path)
+            if known is not None and cached == (stamp, known):
+                return { 'hash': known, 'unchanged': True }
+            with open(path, 'rb') as f:
+                data = f.read()
+        except (IOError, OSError) as e:
+            return { 'error': str(e) }
+        digest = hashlib.sha1(data).hexdigest()
+        self.sources[path] = (stamp, digest)
+        if digest == known:
+            return { 'hash': digest, 'unchanged': True }
+        # The client keeps the bytes that were hashed, so text that is not
+        # UTF-8 goes as base64 rather than being decoded with replacements.
+        #
+        try:
+            return { 'hash': digest, 'text': data.decode('utf-8') }
+        except UnicodeDecodeError:
+            return { 'hash': digest, 'data': base64.b64encode(data).decode('ascii') }
 
     def to_loc(self, sal):
         if sal is not None and sal.symtab is not None:
-            return sal.symtab.fullname(), int(sal.line)
+            # Only files named this way are served to observers
+            #
+            filename = sal.symtab.fullname()
+            self.source_files.add(filename)
+            return filename, int(sal.line)
         else:
             return None, None
 
@@ -204,54 +663,53 @@ class Gdb(object):
                 pass
             else:
                 if locs:
-                    return [ self.to_loc(loc) for loc in locs if self.to_loc(loc) ]
+                    return [ loc for loc in map(self.to_loc, locs) if loc[0] is not None ]
         return []
 
     def mark_breakpoints(self):
-        breakpoints = []
-        if gdb.breakpoints() is not None:
-            breakpoints = gdb.breakpoints()
-        new_breakpoints = {}
-        for breakpoint in breakpoints:
-            for filename, line in self.get_locations(breakpoint):
-                if filename is not None and breakpoint.enabled:
-                    new_breakpoints[(filename, line)] = 'breakpoint'
-        if self.filename is not None:
-            name = 'pc_and_breakpoint' if (self.filename, self.line) in new_breakpoints.keys() else 'just_pc'
-            new_breakpoints[(self.filename, self.line)] = name
-
-        old_breakpoints = set(self.breakpoints.keys())
-        remove = { key: self.breakpoints[key] for key in old_breakpoints - set(new_breakpoints.keys()) }
-        for (filename, line), (num, _) in remove.items():
-            self.vim(op='unplace', num=num)
-            del self.breakpoints[(filename, line)]
-
-        for (filename, line), name in new_breakpoints.items():
-            if (filename, line) not in self.breakpoints:
+        if not self.events:
+            self.index.rebuild(gdb.breakpoints() or [])
+        dirty = self.index.take_dirty()
+        pc = (self.filename, self.line) if self.filename is not None else None
+        if pc != self.marked_pc:
+            dirty.update(loc for loc in (pc, self.marked_pc) if loc is not None)
+            self.marked_pc = pc
+
+        for filename, line in dirty:
+            if (filename, line) == pc:
+                name = 'pc_and_breakpoint' if self.index.enabled_at(pc) else 'just_pc'
+            elif self.index.enabled_at((filename, line)):
+                name = 'breakpoint'
+            else:
+                name = None
+            self.update_sign(filename, line, name)
+
+    def update_sign(self, filename, line, name):
+        if (filename, line) not in self.breakpoints:
+            if name is not None:
                 self.breakpoints[(filename, line)] = (self.next_breakpoint, name)
-                self.vim(op='place', num=self.next_breakpoint, name=name, line=line, filename=filename)
+                self.batch.append(dict(op='place', num=self.next_breakpoint, name=name, line=line, filename=filename))
                 self.next_breakpoint += 1
-            else:
-                num, old_name = self.breakpoints[(filename, line)]
-                if old_name != name:
-                    self.breakpoints[(filename, line)] = (num, name)
-                    self.vim(op='replace', num=num, name=name, filename=filename)
+        elif name is None:
+            num, _ = self.breakpoints.pop((filename, line))
+            self.batch.append(dict(op='unplace', num=num))
+        else:
+            num, old_name = self.breakpoints[(filename, line)]
+            if old_name != name:
+                self.breakpoints[(filename, line)] = (num, name)
+                self.batch.append(dict(op='replace', num=num, name=name, filename=filename))
 
     def disable_breakpoints(self, filename, line):
-        if gdb.breakpoints() is not None:
-            for breakpoint in gdb.breakpoints():
-                for old_filename, old_line in self.get_locations(breakpoint):
-                    if (old_filename, old_line) == (filename, line):
-                        breakpoint.delete()
+        for breakpoint in self.index.at((filename, line)):
+            if breakpoint.is_valid():
+                breakpoint.delete()
 
     def toggle_breakpoints(self, filename, line):
         found = False
-        if gdb.breakpoints() is not None:
-            for breakpoint in gdb.breakpoints():
-                for old_filename, old_line in self.get_locations(breakpoint):
-                    if (old_filename, old_line) == (filename, line) and breakpoint.is_valid():
-                        breakpoint.delete()
-                        found = True
+        for breakpoint in self.index.at((filename, line)):
+            if breakpoint.is_valid():
+                breakpoint.delete()
+                found = True
         if not found:
             gdb.execute("break %s:%d" % (filename, line))
 
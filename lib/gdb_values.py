@@ -1,6 +1,14 @@
 import re
+import time
+import struct
 import gdb
 
+# Elements shown when an array or vector is first expanded, and in each
+# further window requested from it.
+#
+FIRST_PAGE = 10
+PAGE = 100
+
 def get_str(value):
     try:
         try:
@@ -12,171 +20,685 @@ def get_str(value):
     except gdb.MemoryError as e:
         return str(e)
 
-def gdb_to_py(name, value):
+class Budget(object):
+    """Caps the nodes, label bytes and time spent rendering one request.
+
+    While a budget is active (`with Budget(...):`), converters keep rendering
+    until it runs out and then leave everything else as lazily expandable
+    children, which the client can request later as continuations.
+    """
+    _active = []
+
+    def __init__(self, nodes=None, size=None, seconds=None):
+        self.nodes = nodes
+        self.size = size
+        self.deadline = None if seconds is None else time.time() + seconds
+        self.used_nodes = 0
+        self.used_bytes = 0
+        self.partial = False
+
+    def __enter__(self):
+        Budget._active.append(self)
+        return self
+
+    def __exit__(self, type, value, tb):
+        Budget._active.remove(self)
+
+    def exhausted(self):
+        if not self.partial:
+            self.partial = ((self.nodes is not None and self.used_nodes >= self.nodes) or
+                            (self.size is not None and self.used_bytes >= self.size) or
+                            (self.deadline is not None and time.time() >= self.deadline))
+        return self.partial
+
+    def charge(self, contents):
+        for label, child in contents.items():
+            self.used_nodes += 1
+            self.used_bytes += len(label) + (0 if isinstance(child, (dict, int)) else len(child))
+
+def exhausted():
+    return bool(Budget._active) and Budget._active[-1].exhausted()
+
+def nodes_left():
+    """How many more nodes the active budget allows, or None for no limit."""
+    if not Budget._active or Budget._active[-1].nodes is None:
+        return None
+    budget = Budget._active[-1]
+    return max(0, budget.nodes - budget.used_nodes)
+
+def charge(contents):
+    if Budget._active:
+        Budget._active[-1].charge(contents)
+
+class TypeInfo(object):
+    """How gdb_to_py renders values of one type, worked out once per type.
+
+    `transform` rewrites a value into another one (a pointer into its target,
+    a vector into an array...) and may return None when it does not apply to
+    this particular value.  Once no transform applies, `converter` renders it.
+    """
+    def __init__(self, t, typename, transform, converter):
+        self.type = t
+        self.name = typename
+        self.transform = transform
+        self.converter = converter
+        self._fields = None
+        self._scalar = False
+        self.printer = None
+
+    def fields(self):
+        if self._fields is None:
+            self._fields = [ (f.name, f.type, "%s (%s)" % (f.name, f.type), f.is_base_class) for f in self.type.fields() ]
+        return self._fields
+
+    def scalar(self):
+        """(struct code, formatter) when values of this type can be decoded
+        from raw memory exactly as gdb would print them, otherwise None."""
+        if self._scalar is False:
+            self._scalar = _scalar_format(self.type.strip_typedefs())
+        return self._scalar
 
-    t = value.type
+def _scalar_format(t):
+    if t.code == gdb.TYPE_CODE_BOOL and t.sizeof == 1:
+        return '?', lambda v: 'true' if v else 'false'
+    if t.code == gdb.TYPE_CODE_INT and t.sizeof in (2, 4, 8) and 'char' not in str(t):
+        code = { 2: 'h', 4: 'i', 8: 'q' }[t.sizeof]
+        signed = t.is_signed if hasattr(t, 'is_signed') else 'unsigned' not in str(t)
+        return (code if signed else code.upper()), str
+    if t.code == gdb.TYPE_CODE_FLT and t.sizeof == 4:
+        return 'f', lambda v: '%.9g' % v
+    if t.code == gdb.TYPE_CODE_FLT and t.sizeof == 8:
+        return 'd', lambda v: '%.17g' % v
+    return None
+
+_type_cache = {}
+_byte_order = []
+
+def invalidate_types():
+    _type_cache.clear()
+    del _byte_order[:]
+
+def byte_order():
+    if not _byte_order:
+        big = 'big endian' in gdb.execute("show endian", to_string=True)
+        _byte_order.append('>' if big else '<')
+    return _byte_order[0]
+
+def type_info(t):
+    if t is None:
+        return _none_info
+    if isinstance(t, TypeInfo):
+        return t
     typename = str(t)
+    if '{...}' in typename:
+        # Every anonymous struct, union or enum is named alike, so their
+        # info cannot be shared.
+        #
+        return TypeInfo(t, typename, *_resolve(t, typename))
+    key = (t.code, typename)
+    try:
+        return _type_cache[key]
+    except KeyError:
+        info = _type_cache[key] = TypeInfo(t, typename, *_resolve(t, typename))
+        return info
+
+def _resolve(t, typename):
+    code = t.code
+    if code == gdb.TYPE_CODE_REF:
+        return ref_transform, None
+    if code == gdb.TYPE_CODE_TYPEDEF:
+        return typedef_transform, None
+    if code == gdb.TYPE_CODE_PTR:
+        if str(t.target().unqualified()) == 'char':
+            return null_transform, string_to_py
+        return ptr_transform, None
+    if code == gdb.TYPE_CODE_STRUCT:
+        transform = _name_transforms.get(typename.split('<', 1)[0])
+        if transform is not None:
+            return transform, None
+        return visualizer_transform, struct_to_py
+    if code == gdb.TYPE_CODE_UNION:
+        return None, struct_to_py
+    if code == gdb.TYPE_CODE_ARRAY and str(t.target().unqualified()) != 'char':
+        return None, array_to_py
+    return None, one_liner_to_py
+
+def resolve(name, fullname, value, info):
+    """Run the transforms for `value` until one of the converters applies.
+
+    Returns the rewritten (name, fullname, value, type) and the converter.
+    """
+    t = info.type
+    while info.transform is not None:
+        transformed = info.transform(name, fullname, value, t)
+        if transformed is None:
+            break
+        name, fullname, value, t = transformed
+        info = type_info(t)
+    return name, fullname, value, t, info.converter
+
+def expand(name, value):
+    """Resolve a named value as gdb_to_py would, so that callers can inspect
+    the converter before committing to render it."""
+    info = type_info(value.type)
+    return resolve("%s (%s)" % (name, info.name), name, value, info)
+
+def is_one_liner(converter):
+    return converter in (one_liner_to_py, string_to_py)
+
+def string_to_py(name, fullname, value, t):
+    return { name + ': ' + get_str(value): 0 }
+
+def struct_entries(fullname, value, info):
+    """Yield the rendered fields of a struct one at a time."""
+    for field_name, sub_type, sub_field_name, is_base_class in info.fields():
+        if is_base_class:
+            yield { field_name: "static_cast<%s >(%s)" % (sub_type, fullname) }
+        elif field_name:
+            try:
+                assert(not exhausted())
+                resolved = expand(field_name, value[field_name])
+                assert(is_one_liner(resolved[-1]))
+                this = convert(*resolved)
+            except gdb.error as e:
+                this = { sub_field_name + ': ' + str(e): 0 }
+            except:
+                this = { sub_field_name: fullname + '.' + field_name }
+            charge(this)
+            yield this
+        else:
+            yield { sub_field_name: merged(struct_entries(fullname, value, type_info(sub_type))) }
+
+def struct_to_py(name, fullname, value, t):
+    return { name: merged(struct_entries(fullname, value, type_info(t))) }
+
+class Sequence(object):
+    """Elements laid out contiguously: a C array, the storage of a vector or
+    the memory behind a pointer.
 
-    fullname = name
-    name = "%s (%s)" % (name, typename)
+    `expr` names the whole sequence in window requests (`expr[start:stop]`)
+    and `element_base[i]` names a single element, or its address does when
+    `element_base` is None.  `length` is None when the bounds are unknown, as
+    for a bare pointer.  `items` only needs to support indexing.
+    """
+    def __init__(self, expr, element_base, items, element_type, length, address=None):
+        self.expr = expr
+        self.element_base = element_base
+        self.items = items
+        self.type = element_type
+        self.length = length
+        self.address = address
 
-    def transform(name, fullname, value, t):
-        while True:
-            matches = [ transform for filt, transform in transforms if filt(value, t) ]
-            if len(matches) == 0:
+    def read_scalars(self, start, stop):
+        """Decode a window of scalars with a single memory read."""
+        scalar = type_info(self.type).scalar()
+        if scalar is None or self.address is None or stop <= start:
+            return None
+        code, render = scalar
+        size = self.type.sizeof
+        try:
+            data = gdb.selected_inferior().read_memory(self.address + start * size, (stop - start) * size)
+        except gdb.error:
+            return None
+        return [ render(v) for v in struct.unpack_from("%s%d%s" % (byte_order(), stop - start, code), data) ]
+
+    def window(self, start, stop):
+        return merged(self.entries(start, stop))
+
+    def entries(self, start, stop):
+        """Yield the rendered elements of [start, stop) one at a time, then
+        the continuation if any are left.  At most a page of elements, and no
+        more than the budget allows, is rendered (and read) at once."""
+        if self.length is not None:
+            stop = min(stop, self.length)
+        stop = min(stop, start + PAGE)
+        left = nodes_left()
+        if left is not None:
+            stop = min(stop, start + left)
+        elem_typename = type_info(self.type).name
+        scalars = self.read_scalars(start, stop)
+        for i in range(start, stop):
+            if exhausted():
+                stop = i
                 break
-            name, fullname, value, t = matches[0](name, fullname, value, t)
-        return name, fullname, value, t
-
-    def get_converter(t):
-        for filt, converter in converters:
-            if filt(t):
-                return converter
-
-    def is_one_liner(value, t):
-        _, _, value, t = transform('', '', value, t)
-        return get_converter(t) in [ one_liner_to_py, string_to_py ]
-
-    def string_to_py(name, fullname, value, t):
-        return { name + ': ' + get_str(value): 0 }
-
-    def struct_to_py(name, fullname, value, t):
-        def _struct_to_py(field):
-            contents = {}
-            for sub_field in field.fields():
-                sub_type = sub_field.type
-                sub_field_name = "%s (%s)" % (sub_field.name, sub_type)
-                if sub_field.is_base_class:
-                    this = { sub_field.name: "static_cast<%s >(%s)" % (sub_type, fullname) }
+            if scalars is not None:
+                this = { "[%d] (%s): %s" % (i, elem_typename, scalars[i - start]): 0 }
+            else:
+                elem_name = "[%d]" % (i)
+                resolved = expand(elem_name, self.items[i])
+                if is_one_liner(resolved[-1]):
+                    this = convert(*resolved)
                 else:
-                    if sub_field.name:
-                        try:
-                            assert(is_one_liner(value[sub_field.name], sub_type))
-                            this = gdb_to_py(sub_field.name, value[sub_field.name])
-                        except gdb.error as e:
-                            this = { sub_field_name + ': ' + str(e): 0 }
-                        except:
-                            this = { sub_field_name: fullname + '.' + sub_field.name }
-                    else:
-                        this = { sub_field_name: _struct_to_py(sub_type) }
-                contents = dict(contents, **this)
-            return contents
-
-        return { name: _struct_to_py(t) }
-
-    def array_to_py(name, fullname, value, t):
-        assert(t.sizeof % t.target().sizeof == 0)
-        size = int(t.sizeof / t.target().sizeof)
-        contents = {}
-        elem_typename = str(t.target())
-        for i in range(min(size, 10)):
-            elem_name = "[%d]" % (i)
-            if is_one_liner(value[i], t.target()):
-                this = gdb_to_py(elem_name, value[i])
+                    this = lazy_element(elem_name, elem_typename, self.items[i],
+                                        None if self.element_base is None else "%s[%d]" % (self.element_base, i))
+            charge(this)
+            yield this
+        if self.length is None or stop < self.length:
+            yield continuation(self.expr, stop, self.length)
+
+class Walk(object):
+    """Elements reached by following links: the nodes of a list, tree or hash
+    table, or the children of a pretty-printer.
+
+    `nodes(cursor)` yields (cursor, key, value) from the node `cursor`, or
+    from the first node when it is None.  The cursor after each window is
+    remembered, so paging forward does not walk the container from the start
+    again.  `key` labels the element, the position is used when it is None.
+    A walk without cursors (`resumable=False`) skips ahead instead.
+    """
+    def __init__(self, expr, length, nodes, resumable=True):
+        self.expr = expr
+        self.length = length
+        self.nodes = nodes
+        self.resumable = resumable
+
+    def window(self, start, stop):
+        return merged(self.entries(start, stop))
+
+    def entries(self, start, stop):
+        if self.length is not None:
+            stop = min(stop, self.length)
+        frame = selected_frame()
+        cursor = _cursors.get((frame, self.expr, start)) if self.resumable else None
+        index = 0 if cursor is None else start
+        for cursor, key, value in self.nodes(cursor):
+            if index >= stop or exhausted():
+                if self.resumable and index >= start:
+                    remember_cursor(frame, self.expr, index, cursor)
+                yield continuation(self.expr, max(start, index), self.length)
+                return
+            if index >= start:
+                this = self.element(index, key, value)
+                charge(this)
+                yield this
+            index += 1
+
+    @staticmethod
+    def element(index, key, value):
+        elem_name = "[%d]" % index if key is None else "[%s]" % summarize(key)
+        try:
+            resolved = expand(elem_name, value)
+            if is_one_liner(resolved[-1]):
+                return convert(*resolved)
+            return lazy_element(elem_name, type_info(value.type).name, value, None)
+        except gdb.error as e:
+            return { elem_name + ': ' + str(e): 0 }
+
+def lazy_element(elem_name, elem_typename, value, expr):
+    """An element left for the client to expand, named by `expr` or else by
+    its address."""
+    label = "%s (%s)" % (elem_name, elem_typename)
+    if expr is None:
+        if value.address is None:
+            return gdb_to_py(elem_name, value)
+        expr = "*(%s *)%d" % (value.type, int(value.address))
+    return { label: expr }
+
+def continuation(expr, stop, length):
+    if length is None:
+        return { "Next %d..." % PAGE: "%s[%d:%d]" % (expr, stop, stop + PAGE) }
+    return { "And %d more..." % (length - stop): "%s[%d:%d]" % (expr, stop, min(length, stop + PAGE)) }
+
+def merged(entries):
+    contents = {}
+    for this in entries:
+        contents.update(this)
+    return contents
+
+# Where the next window of a Walk starts, by (frame, expr, index).  The same
+# expression names another container in another frame or thread, and node
+# addresses only hold while the inferior is stopped.
+#
+_cursors = {}
+MAX_CURSORS = 1024
+
+def selected_frame():
+    try:
+        return str(gdb.selected_frame())
+    except gdb.error:
+        return None
+
+def remember_cursor(frame, expr, index, cursor):
+    if len(_cursors) >= MAX_CURSORS:
+        _cursors.clear()
+    _cursors[(frame, expr, index)] = cursor
+
+def invalidate_walks():
+    _cursors.clear()
+
+def summarize(value):
+    """The text a one-liner would show for `value`, for labelling map keys."""
+    if not isinstance(value, gdb.Value):
+        return u"%s" % value
+    _, _, value, t, converter = expand('', value)
+    if converter is string_to_py:
+        return get_str(value)
+    return u"%s" % value
+
+def array_sequence(fullname, value, t):
+    target = t.target()
+    assert(t.sizeof % target.sizeof == 0)
+    size = int(t.sizeof / target.sizeof)
+    address = int(value.address) if value.address is not None else None
+    return Sequence(fullname, fullname, value, target, size, address)
+
+def sequence_to_py(name, fullname, value, t):
+    return { name: value.window(0, FIRST_PAGE) }
+
+def array_to_py(name, fullname, value, t):
+    return sequence_to_py(name, fullname, array_sequence(fullname, value, t), t)
+
+_window = re.compile(r'^(.*)\[\s*(\d+)\s*:\s*(\d+)\s*\]$')
+
+def parse_window(expr):
+    """Split `expr[start:stop]` into (expr, start, stop), or return None."""
+    m = _window.match(expr)
+    if m is None:
+        return None
+    return m.group(1), int(m.group(2)), int(m.group(3))
+
+_literal = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'')
+_named_cast = re.compile(r'\b(?:static|dynamic|reinterpret|const)_cast\s*<[^()]*>\s*\(')
+_assignment = re.compile(r'<<=|>>=|(?<![=!<>])=(?!=)|\+\+|--')
+_call = re.compile(r'(?:\b(?!sizeof\b|alignof\b)[A-Za-z_$]\w*|[)\]>])\s*\(')
+
+def has_side_effects(expr):
+    """Whether `expr` may change the inferior: an assignment, an increment
+    or a call.  Errs on the side of yes, so that a read-only client can be
+    refused anything else."""
+    expr = _named_cast.sub('(', _literal.sub('""', expr))
+    return bool(_assignment.search(expr) or _call.search(expr))
+
+def window_to_py(name, base, value, start, stop):
+    """Render elements [start, stop) of the array, container or pointer `value`,
+    which `base` evaluates to."""
+    label = name
+    try:
+        info = type_info(value.type)
+        label = "%s (%s)" % (name, info.name)
+        t = value.type.strip_typedefs()
+        if t.code == gdb.TYPE_CODE_PTR:
+            seq = Sequence(base, base, value, t.target(), None, int(value))
+        else:
+            _, fullname, value, t, converter = resolve(label, base, value, info)
+            if converter is array_to_py:
+                seq = array_sequence(fullname, value, t)
+            elif isinstance(value, (Sequence, Walk)):
+                seq = value
             else:
-                this = { "%s (%s)" % (elem_name, elem_typename): "%s[%d]" % (fullname, i) }
-            contents = dict(contents, **this)
-        if size > 10:
-            contents["And %d more..." % (size - 10)] = 0
-        return { name: contents }
-
-    def one_liner_to_py(name, fullname, value, t):
-        s = u"%s" % value
-        return { name + ': ' + s: 0 }
-
-    def atomic_transform(name, fullname, value, t):
-        new_type = t.template_argument(0)
-        return name, fullname, value['m_value']['v_'].cast(new_type), new_type
-
-    def vector_transform(name, fullname, value, t):
-        void_p = gdb.lookup_type('void').pointer()
-        start = int(str(value['_M_impl']['_M_start'].cast(void_p)), 16)
-        finish = int(str(value['_M_impl']['_M_finish'].cast(void_p)), 16)
-        element_type = t.template_argument(0)
-        length = finish - start
-        assert(length % element_type.sizeof == 0)
-        length = int((finish - start) / element_type.sizeof)
-        if length == 0:
-            return name, fullname, 'empty', None
-        new_type = element_type.array(length - 1)
-        return name, fullname + '._M_impl._M_start', value['_M_impl']['_M_start'].cast(new_type), new_type
-
-    def string_transform(name, fullname, value, t):
-        new_val = value['_M_dataplus']['_M_p']
-        new_type = new_val.type
-        return name, fullname + '._M_dataplus._M_p', new_val, new_type
-
-    def ptr_transform(name, fullname, value, t):
-        return name + (' @%s' % value), fullname, value.dereference(), t.target()
-
-    def ref_transform(name, fullname, value, t):
-        return name + (' @%s' % value.address), fullname, value.cast(t.target()), t.target()
-
-    def null_transform(name, fullname, value, t):
+                return { label: { "Not an array, container or pointer": 0 } }
+        return { label: seq.window(start, stop) }
+    except gdb.error as e:
+        return { label: { str(e) : 0 } }
+    except:
+        return server_error()
+
+def one_liner_to_py(name, fullname, value, t):
+    s = u"%s" % value
+    return { name + ': ' + s: 0 }
+
+def atomic_transform(name, fullname, value, t):
+    new_type = t.template_argument(0)
+    return name, fullname, value['m_value']['v_'].cast(new_type), new_type
+
+def vector_transform(name, fullname, value, t):
+    start = value['_M_impl']['_M_start']
+    finish = int(value['_M_impl']['_M_finish'])
+    element_type = t.template_argument(0)
+    length = finish - int(start)
+    assert(length % element_type.sizeof == 0)
+    length = int(length / element_type.sizeof)
+    if length == 0:
+        return name, fullname, 'empty', None
+    seq = Sequence(fullname, fullname + '._M_impl._M_start', start, element_type, length, int(start))
+    return name, fullname, seq, _sequence_info
+
+def _value_at(address, t):
+    return gdb.Value(address).cast(t.pointer()).dereference()
+
+def _node_offset(base, t):
+    """Where a node's payload of type `t` starts after its `base` links."""
+    align = getattr(t, 'alignof', None) or min(t.sizeof, 8) or 1
+    return (base.sizeof + align - 1) // align * align
+
+def _rb_increment(node):
+    right = node.dereference()['_M_right']
+    if int(right) != 0:
+        node = right
+        while int(node.dereference()['_M_left']) != 0:
+            node = node.dereference()['_M_left']
+        return node
+    parent = node.dereference()['_M_parent']
+    while int(node) == int(parent.dereference()['_M_right']):
+        node = parent
+        parent = parent.dereference()['_M_parent']
+    if int(node.dereference()['_M_right']) != int(parent):
+        node = parent
+    return node
+
+def _pair(pairs, element):
+    if pairs:
+        return element['first'], element['second']
+    return None, element
+
+def tree_transform(name, fullname, value, t, pairs):
+    tree = value['_M_t']
+    element_type = tree.type.strip_typedefs().template_argument(1)
+    impl = tree['_M_impl']
+    header = impl['_M_header']
+    end = int(header.address)
+    offset = _node_offset(header.type, element_type)
+
+    def nodes(node):
+        node = header['_M_left'] if node is None else node
+        while int(node) != end:
+            key, element = _pair(pairs, _value_at(int(node) + offset, element_type))
+            yield node, key, element
+            node = _rb_increment(node)
+    return name, fullname, Walk(fullname, int(impl['_M_node_count']), nodes), _sequence_info
+
+def map_transform(name, fullname, value, t):
+    return tree_transform(name, fullname, value, t, True)
+
+def set_transform(name, fullname, value, t):
+    return tree_transform(name, fullname, value, t, False)
+
+def hashtable_transform(name, fullname, value, t, pairs):
+    table = value['_M_h']
+    element_type = table.type.strip_typedefs().template_argument(1)
+    first = table['_M_before_begin']['_M_nxt']
+    offset = _node_offset(first.type.target(), element_type)
+
+    def nodes(node):
+        node = first if node is None else node
+        while int(node) != 0:
+            key, element = _pair(pairs, _value_at(int(node) + offset, element_type))
+            yield node, key, element
+            node = node.dereference()['_M_nxt']
+    return name, fullname, Walk(fullname, int(table['_M_element_count']), nodes), _sequence_info
+
+def unordered_map_transform(name, fullname, value, t):
+    return hashtable_transform(name, fullname, value, t, True)
+
+def unordered_set_transform(name, fullname, value, t):
+    return hashtable_transform(name, fullname, value, t, False)
+
+def list_transform(name, fullname, value, t):
+    element_type = t.template_argument(0)
+    header = value['_M_impl']['_M_node']
+    end = int(header.address)
+    offset = _node_offset(header['_M_next'].type.target(), element_type)
+    try:
+        length = int(header['_M_size'])
+    except gdb.error:
+        # The pre-C++11 ABI does not store the size.
+        length = None
+
+    def nodes(node):
+        node = header['_M_next'] if node is None else node
+        while int(node) != end:
+            yield node, None, _value_at(int(node) + offset, element_type)
+            node = node.dereference()['_M_next']
+    return name, fullname, Walk(fullname, length, nodes), _sequence_info
+
+class DequeItems(object):
+    """Indexes the elements of a deque through its map of buffers."""
+    def __init__(self, start, element_type):
+        size = element_type.sizeof
+        first = int(start['_M_first'])
+        self.buffer = (int(start['_M_last']) - first) // size
+        self.skip = (int(start['_M_cur']) - first) // size
+        self.node = start['_M_node']
+
+    def __getitem__(self, i):
+        i += self.skip
+        return ((self.node + i // self.buffer).dereference() + i % self.buffer).dereference()
+
+def deque_transform(name, fullname, value, t):
+    element_type = t.template_argument(0)
+    start = value['_M_impl']['_M_start']
+    finish = value['_M_impl']['_M_finish']
+    items = DequeItems(start, element_type)
+    size = element_type.sizeof
+    nodes = (int(finish['_M_node']) - int(start['_M_node'])) // start['_M_node'].type.target().sizeof
+    length = (items.buffer * (nodes - 1) + (int(finish['_M_cur']) - int(finish['_M_first'])) // size
+              + (int(start['_M_last']) - int(start['_M_cur'])) // size)
+    if length == 0:
+        return name, fullname, 'empty', None
+    return name, fullname, Sequence(fullname, None, items, element_type, length), _sequence_info
+
+def visualizer_transform(name, fullname, value, t):
+    """Walk the children of a registered pretty-printer, for containers
+    without a transform of their own.  Only printers that say they show an
+    array or a map are walked, as the names of other printers' children are
+    labels worth keeping; those types are rendered as structs.  Whether a
+    type has such a printer is looked up once."""
+    info = type_info(t)
+    if info.printer is False:
+        return None
+    printer = gdb.default_visualizer(value)
+    hint = printer.display_hint() if hasattr(printer, 'display_hint') else None
+    info.printer = printer is not None and hasattr(printer, 'children') and hint in ('array', 'map')
+    if not info.printer:
+        return None
+    pairs = hint == 'map'
+
+    def nodes(cursor):
+        children = (child if isinstance(child, gdb.Value) else gdb.Value(child) for _, child in printer.children())
+        for child in children:
+            if not pairs:
+                yield None, None, child
+                continue
+            try:
+                yield None, child, next(children)
+            except StopIteration:
+                return
+    return name, fullname, Walk(fullname, None, nodes, resumable=False), _sequence_info
+
+def string_transform(name, fullname, value, t):
+    new_val = value['_M_dataplus']['_M_p']
+    new_type = new_val.type
+    return name, fullname + '._M_dataplus._M_p', new_val, new_type
+
+def null_transform(name, fullname, value, t):
+    if int(value) != 0:
+        return None
+    return name, fullname, 'nullptr', None
+
+def ptr_transform(name, fullname, value, t):
+    if int(value) == 0:
         return name, fullname, 'nullptr', None
+    return name + (' @%s' % value), fullname, value.dereference(), t.target()
+
+def ref_transform(name, fullname, value, t):
+    return name + (' @%s' % value.address), fullname, value.cast(t.target()), t.target()
+
+def typedef_transform(name, fullname, value, t):
+    return name, fullname, value, t.strip_typedefs()
 
-    def typedef_transform(name, fullname, value, t):
-        return name, fullname, value, t.strip_typedefs()
-
-    transforms = [
-        (lambda value, t: t is not None and
-                   t.code == gdb.TYPE_CODE_REF,
-            ref_transform),
-        (lambda value, t: t is not None and
-                   t.code == gdb.TYPE_CODE_TYPEDEF,
-            typedef_transform),
-        (lambda value, t: t is not None and
-                   t.code == gdb.TYPE_CODE_PTR and
-                   str(value) == '0x0',
-            null_transform),
-        (lambda value, t: t is not None and
-                   t.code == gdb.TYPE_CODE_PTR and
-                   str(t.target().unqualified()) != 'char',
-            ptr_transform),
-        (lambda value, t: t is not None and
-                   t.code == gdb.TYPE_CODE_STRUCT and
-                   str(t).startswith("SimpleAtomic"),
-            atomic_transform),
-        (lambda value, t: t is not None and
-                   t.code == gdb.TYPE_CODE_STRUCT and
-                   str(t).startswith("std::vector"),
-            vector_transform),
-        (lambda value, t: t is not None and
-                   t.code == gdb.TYPE_CODE_STRUCT and
-                   str(t).startswith("std::basic_string"),
-            string_transform),
-    ]
-
-    converters = [
-        (lambda t: t is not None and
-                   t.code == gdb.TYPE_CODE_PTR and
-                   str(t.target().unqualified()) == 'char',
-            string_to_py),
-        (lambda t: t is not None and
-                   t.code in [ gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION ],
-            struct_to_py),
-        (lambda t: t is not None and
-                   t.code == gdb.TYPE_CODE_ARRAY and
-                   str(t.target().unqualified()) != 'char',
-            array_to_py),
-        (lambda t: True,
-            one_liner_to_py),
-    ]
+# Struct transforms, indexed by the type name up to its template arguments.
+#
+_name_transforms = {
+    'SimpleAtomic': atomic_transform,
+    'std::vector': vector_transform,
+    'std::basic_string': string_transform,
+    'std::__cxx11::basic_string': string_transform,
+    'std::map': map_transform,
+    'std::multimap': map_transform,
+    'std::set': set_transform,
+    'std::multiset': set_transform,
+    'std::unordered_map': unordered_map_transform,
+    'std::unordered_multimap': unordered_map_transform,
+    'std::unordered_set': unordered_set_transform,
+    'std::unordered_multiset': unordered_set_transform,
+    'std::list': list_transform,
+    'std::__cxx11::list': list_transform,
+    'std::deque': deque_transform,
+}
 
+_none_info = TypeInfo(None, 'None', None, one_liner_to_py)
+_sequence_info = TypeInfo(None, 'sequence', None, sequence_to_py)
+
+def server_error():
+    import traceback
+    lines = traceback.format_exc().split('\n')
+    p = len("%d" % len(lines))
+    return { "Python server error": { "%0*d: %s" % (p, i, line): 0 for i, line in enumerate(lines) } }
+
+def convert(name, fullname, value, t, converter):
     try:
-        name, fullname, value, t = transform(name, fullname, value, t)
-        return get_converter(t)(name, fullname, value, t)
+        return converter(name, fullname, value, t)
     except gdb.error as e:
         return { name: { str(e) : 0 } }
     except:
-        import traceback
-        lines = traceback.format_exc().split('\n')
-        p = len("%d" % len(lines))
-        return { "Python server error": { "%0*d: %s" % (p, i, line): 0 for i, line in enumerate(lines) } }
+        return server_error()
+
+def gdb_to_py(name, value):
+    label = name
+    try:
+        info = type_info(value.type)
+        label = "%s (%s)" % (name, info.name)
+        return convert(*resolve(label, name, value, info))
+    except gdb.error as e:
+        return { label: { str(e) : 0 } }
+    except:
+        return server_error()
+
+def gdb_to_py_chunks(name, value, size):
+    """Render `value` as gdb_to_py does, but yield its top level in chunks of
+    up to `size` entries as they are produced, as (label, contents) pairs."""
+    label = name
+    try:
+        info = type_info(value.type)
+        label = "%s (%s)" % (name, info.name)
+        name, fullname, value, t, converter = resolve(label, name, value, info)
+        if converter is struct_to_py:
+            entries = struct_entries(fullname, value, type_info(t))
+        elif converter is array_to_py:
+            entries = array_sequence(fullname, value, t).entries(0, FIRST_PAGE)
+        elif converter is sequence_to_py:
+            entries = value.entries(0, FIRST_PAGE)
+        else:
+            for item in convert(name, fullname, value, t, converter).items():
+                yield item
+            return
+        chunk = {}
+        for this in entries:
+            chunk.update(this)
+            if len(chunk) >= size:
+                yield name, chunk
+                chunk = {}
+        if chunk:
+            yield name, chunk
+    except gdb.error as e:
+        yield label, { str(e) : 0 }
+    except Exception:
+        for item in server_error().items():
+            yield item
 
 def extract_vars(cmd):
     try:
-        lines = gdb.execute("info args", to_string=True).split('\n')[:-1]
+        lines = gdb.execute(cmd, to_string=True).split('\n')[:-1]
     except gdb.error:
         return
 
@@ -186,19 +708,64 @@ def extract_vars(cmd):
         if m is not None:
             yield m.group(1)
 
-def locals_to_py():
-    variables = list(extract_vars("info args"))
-    variables += list(extract_vars("info locals"))
-    contents = {}
-    for var in variables:
-        try:
-            value = gdb.parse_and_eval(var)
+def frame_symbols(frame):
+    """The arguments and then the locals visible at the frame's pc, innermost
+    declaration first when a name is shadowed."""
+    block = frame.block()
+    seen = set()
+    args, variables = [], []
+    while block is not None:
+        for symbol in block:
+            if symbol.name in seen or not (symbol.is_argument or symbol.is_variable):
+                continue
+            seen.add(symbol.name)
+            (args if symbol.is_argument else variables).append(symbol)
+        if block.function is not None:
+            break
+        block = block.superblock
+    return args + variables
+
+def frame_values():
+    """Yields (name, value) for every argument and local of the selected
+    frame, or (name, gdb.error) when the value cannot be read.
+
+    Symbols come from the frame's block so that gdb does not have to format
+    every value for 'info locals'; frames without debug info fall back to
+    parsing that output.
+    """
+    try:
+        frame = gdb.selected_frame()
+        symbols = frame_symbols(frame)
+    except (RuntimeError, gdb.error):
+        for var in list(extract_vars("info args")) + list(extract_vars("info locals")):
+            try:
+                yield var, gdb.parse_and_eval(var)
+            except gdb.error as e:
+                yield var, e
+        return
 
+    for symbol in symbols:
+        try:
+            yield symbol.name, symbol.value(frame)
         except gdb.error as e:
-            if var != 'this':
-                contents = dict(contents, **{ var: { str(e): 0 } })
+            yield symbol.name, e
 
+def locals_by_name():
+    """Each local rendered on its own, so that stops can be diffed by name."""
+    variables = {}
+    for var, value in frame_values():
+        if isinstance(value, gdb.error):
+            if var != 'this':
+                variables[var] = { var: { str(value): 0 } }
+        elif exhausted():
+            variables[var] = { "%s (%s)" % (var, type_info(value.type).name): var }
         else:
-            contents = dict(contents, **gdb_to_py(var, value))
-    return contents
+            variables[var] = gdb_to_py(var, value)
+        charge(variables.get(var, {}))
+    return variables
 
+def locals_to_py():
+    contents = {}
+    for rendered in locals_by_name().values():
+        contents.update(rendered)
+    return contents
@@ -1,6 +1,29 @@
-import struct, select, signal, socket, threading, json
+import os, struct, select, signal, socket, threading, json, marshal, sys, mmap, binascii, time, errno
 from pysigset_exterminator import suspended_signals
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    from multiprocessing.connection import Connection
+except ImportError:
+    from _multiprocessing import Connection
+
+# Every packet is preceded by its payload length and the id of the codec that
+# encoded it, in network byte order.  Carrying the codec id in each header lets
+# either side switch codecs without synchronizing with its peer.
+#
+HEADER = struct.Struct('!IB')
+
+# A tunnel carrying several connections frames each piece of their streams
+# with its kind, its channel and its length.  Opening and closing frames are
+# empty.
+#
+MUX_HEADER = struct.Struct('!BII')
+MUX_OPEN, MUX_DATA, MUX_CLOSE = range(3)
+
 class MalformedPacket(BaseException):
     def __init__(self, packet, reason):
         self._packet = packet
@@ -14,51 +37,169 @@ class MalformedPacket(BaseException):
     def __str__(self):
         return repr(self)
 
+class Codec(object):
+    def __init__(self, name, ident, dumps, loads):
+        self.name = name
+        self.ident = ident
+        self.dumps = dumps
+        self.loads = loads
+
+# Codecs in order of preference.  JSON is always available and is what both
+# sides speak until the handshake has picked something better.
+#
+CODECS = []
+
+def register_codec(name, ident, dumps, loads):
+    CODECS.insert(0, Codec(name, ident, dumps, loads))
+
+def find_codec(name=None, ident=None):
+    for codec in CODECS:
+        if codec.name == name or codec.ident == ident:
+            return codec
+    raise KeyError(name if ident is None else ident)
+
+def available_codecs():
+    return [ codec.name for codec in CODECS ]
+
+JSON_IDENT = 0
+register_codec('json', JSON_IDENT,
+        lambda packet: json.dumps(packet).encode('utf8'),
+        lambda data: json.loads(data.decode('utf-8')))
+
+# msgpack is optional.  Unlike marshal it can bridge a Python 2 vim and a
+# Python 3 gdb.
+#
+if msgpack is not None:
+    try:
+        msgpack.unpackb(msgpack.packb(u''), raw=False)
+        _msgpack_options = { 'raw': False }
+    except TypeError:
+        _msgpack_options = { 'encoding': 'utf-8' }
+    register_codec('msgpack', 2,
+            lambda packet: msgpack.packb(packet, use_bin_type=False),
+            lambda data: msgpack.unpackb(data, **_msgpack_options))
+
+# marshal's format is only stable within a major version of the interpreter,
+# so the name carries it and the two sides only agree on it when they match.
+# Version 4 is the newest format every Python 3 can read.
+#
+_marshal_version = min(marshal.version, 4)
+register_codec('marshal-py%d' % sys.version_info[0], 1,
+        lambda packet: marshal.dumps(packet, _marshal_version),
+        marshal.loads)
+
+class RecvBuffer(object):
+    """Read-ahead buffer for stream transports.
+
+    Fills a preallocated bytearray with as much as the transport has ready, so
+    that several frames can be split out of a single read and a large payload
+    is assembled in place rather than by repeated concatenation.
+    """
+    def __init__(self, read_into, size=65536):
+        self._read_into = read_into
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def pending(self):
+        return self._end - self._start
+
+    def _reserve(self, size):
+        if self._start + size <= len(self._buf):
+            return
+        pending = self.pending()
+        if size > len(self._buf):
+            buf = bytearray(max(size, 2 * len(self._buf)))
+            buf[:pending] = self._buf[self._start:self._end]
+            self._buf = buf
+        else:
+            self._buf[:pending] = self._buf[self._start:self._end]
+        self._start, self._end = 0, pending
+
+    def recv_bytes(self, size):
+        self._reserve(size)
+        view = memoryview(self._buf)
+        while self.pending() < size:
+            count = self._read_into(view[self._end:])
+            if count == 0:
+                raise EOFError
+            self._end += count
+        msg = view[self._start:self._start + size].tobytes()
+        self._start += size
+        if self._start == self._end:
+            self._start, self._end = 0, 0
+        return msg
+
+    def fill(self, read_into):
+        """Read once with `read_into`, which must not block and returns None
+        when nothing has arrived.  EOFError at the end of the stream."""
+        self._reserve(self.pending() + 4096)
+        count = read_into(memoryview(self._buf)[self._end:])
+        if count == 0:
+            raise EOFError
+        if count:
+            self._end += count
+
+    def peek(self, size):
+        """The next `size` bytes, left in the buffer, or None if fewer
+        have arrived."""
+        if self.pending() < size:
+            return None
+        return bytes(self._buf[self._start:self._start + size])
+
 class SshSocket(object):
     def __init__(self, channel):
         self._channel = channel
+        self._buffer = RecvBuffer(self._read_into)
 
     def send_bytes(self, msg):
         self._channel.send(msg)
 
-    def recv_bytes(self, size):
-        msg = ''
-        while size > 0:
+    def _read_into(self, view):
+        while True:
             try:
-                part = self._channel.recv(size)
+                part = self._channel.recv(len(view))
             except socket.timeout:
+                select.select([self._channel], [], [])
                 continue
-            if len(part) == 0:
-                raise EOFError
-            size -= len(part)
-            msg += part
-        return msg
+            view[:len(part)] = part
+            return len(part)
+
+    def recv_bytes(self, size):
+        return self._buffer.recv_bytes(size)
+
+    def pending(self):
+        return self._buffer.pending() > 0
 
     def fileno(self):
         return self._channel.fileno()
 
     def poll(self):
-        return self._channel.recv_ready()
+        return self.pending() or self._channel.recv_ready()
 
 class StdioSocket(object):
     def __init__(self, infile, outfile):
         self._infile = infile
         self._outfile = outfile
-        self._eof = False
+        self._buffer = RecvBuffer(self._read_into)
 
     def send_bytes(self, msg):
         self._outfile.write(msg)
         self._outfile.flush()
 
+    def _read_into(self, view):
+        fd = self._infile.fileno()
+        if hasattr(os, 'readv'):
+            return os.readv(fd, [ view ])
+        part = os.read(fd, len(view))
+        view[:len(part)] = part
+        return len(part)
+
     def recv_bytes(self, size):
-        if self._eof:
-            raise EOFError
-        msg = self._infile.read(size)
-        if len(msg) < size:
-            self._eof = True
-        if len(msg) == 0:
-            raise EOFError
-        return msg
+        return self._buffer.recv_bytes(size)
+
+    def pending(self):
+        return self._buffer.pending() > 0
 
     def fileno(self):
         return self._infile.fileno()
@@ -66,38 +207,397 @@ class StdioSocket(object):
     def poll(self):
         return True
 
+class StreamSocket(object):
+    """A connected stream socket carrying bare frames, with none of the
+    per-message framing that multiprocessing's Connection adds."""
+    def __init__(self, sock):
+        self._sock = sock
+        self._buffer = RecvBuffer(sock.recv_into)
+
+    @classmethod
+    def connect_unix(cls, path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(unix_address(path))
+        return cls(sock)
+
+    def send_bytes(self, msg):
+        self._sock.sendall(msg)
+
+    def wire(self, messages):
+        return b''.join(messages)
+
+    def recv_bytes(self, size):
+        return self._buffer.recv_bytes(size)
+
+    def recv_some(self, size=65536):
+        """Up to `size` bytes of what is buffered or, failing that, of what
+        one read returns.  Empty at the end of the stream."""
+        pending = self._buffer.pending()
+        if pending:
+            return self._buffer.recv_bytes(min(pending, size))
+        return self._sock.recv(size)
+
+    def fill(self):
+        """Buffer whatever has arrived, without waiting for more."""
+        self._buffer.fill(self._recv_nowait)
+
+    def _recv_nowait(self, view):
+        try:
+            return self._sock.recv_into(view, len(view), socket.MSG_DONTWAIT)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return None
+            raise
+
+    def peek(self, size):
+        return self._buffer.peek(size)
+
+    def buffered(self):
+        return self._buffer.pending()
+
+    def has_frame(self):
+        """Whether a whole ProtocolSocket frame is buffered."""
+        header = self.peek(HEADER.size)
+        return header is not None and self.buffered() >= HEADER.size + HEADER.unpack(header)[0]
+
+    def pending(self):
+        return self._buffer.pending() > 0
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        self._sock.close()
+
+class MessageSocket(object):
+    """A stream socket carrying the length-prefixed messages of
+    multiprocessing's Connection, which clients of a proxy's TCP port send.
+    Unlike a Connection, it can be read without blocking."""
+    SIZE = struct.Struct('!i')
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._stream = StreamSocket(sock)
+
+    @classmethod
+    def connect(cls, address):
+        return cls(socket.create_connection(address))
+
+    def send_bytes(self, msg):
+        self._sock.sendall(self.wire([ msg ]))
+
+    def wire(self, messages):
+        return b''.join(self.SIZE.pack(len(msg)) + bytes(msg) for msg in messages)
+
+    def recv_bytes(self, size=None):
+        length, = self.SIZE.unpack(self._stream.recv_bytes(self.SIZE.size))
+        return self._stream.recv_bytes(length)
+
+    def fill(self):
+        self._stream.fill()
+
+    def has_frame(self):
+        """Whether a whole ProtocolSocket frame, a header message and a
+        payload message, is buffered."""
+        end = 0
+        for message in range(2):
+            prefix = self._stream.peek(end + self.SIZE.size)
+            if prefix is None:
+                return False
+            end += self.SIZE.size + self.SIZE.unpack(prefix[end:])[0]
+        return self._stream.buffered() >= end
+
+    def pending(self):
+        return self._stream.pending()
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        self._sock.close()
+
+class TcpListener(object):
+    """Accepts connections from multiprocessing's Client on `address`, as
+    MessageSockets."""
+    def __init__(self, address):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(address)
+        self._sock.listen(5)
+        self.address = self._sock.getsockname()
+
+    def accept(self):
+        return MessageSocket(self._sock.accept()[0])
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        self._sock.close()
+
+def unix_address(path):
+    """Paths starting with '@' name sockets in Linux's abstract namespace,
+    which need no file and vanish with their last reference."""
+    return '\0' + path[1:] if path.startswith('@') else path
+
+class UnixListener(object):
+    """Accepts StreamSocket connections on a Unix socket.  Without a path, a
+    unique abstract name is chosen."""
+    def __init__(self, path=None):
+        if path is None:
+            path = '@exterminator-%d-%s' % (os.getpid(), binascii.hexlify(os.urandom(4)).decode('ascii'))
+        self.address = path
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(unix_address(path))
+        self._sock.listen(5)
+
+    def accept(self):
+        return StreamSocket(self._sock.accept()[0])
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        self._sock.close()
+        if not self.address.startswith('@'):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+class ShmRing(object):
+    """A single producer, single consumer byte ring in shared memory.
+
+    The first 16 bytes hold the total bytes ever written and read.  Each
+    counter has exactly one writer, so no locking is needed.
+    """
+    COUNTERS = struct.Struct('=QQ')
+
+    def __init__(self, size):
+        self.size = size
+        self._mem = mmap.mmap(-1, self.COUNTERS.size + size)
+        try:
+            self._data = memoryview(self._mem)[self.COUNTERS.size:]
+        except TypeError:
+            # Python 2's mmap has no buffer interface; go through slices.
+            self._data = None
+
+    def readable(self):
+        head, tail = self.COUNTERS.unpack_from(self._mem, 0)
+        return head - tail
+
+    def _put(self, start, view):
+        if self._data is not None:
+            self._data[start:start + len(view)] = view
+        else:
+            start += self.COUNTERS.size
+            self._mem[start:start + len(view)] = view.tobytes()
+
+    def _get(self, start, view):
+        if self._data is not None:
+            view[:] = self._data[start:start + len(view)]
+        else:
+            start += self.COUNTERS.size
+            view[:] = self._mem[start:start + len(view)]
+
+    def write(self, view):
+        head, tail = self.COUNTERS.unpack_from(self._mem, 0)
+        count = min(len(view), self.size - (head - tail))
+        start = head % self.size
+        first = min(count, self.size - start)
+        self._put(start, view[:first])
+        self._put(0, view[first:count])
+        struct.pack_into('=Q', self._mem, 0, head + count)
+        return count
+
+    def read_into(self, view):
+        head, tail = self.COUNTERS.unpack_from(self._mem, 0)
+        count = min(len(view), head - tail)
+        start = tail % self.size
+        first = min(count, self.size - start)
+        self._get(start, view[:first])
+        self._get(0, view[first:count])
+        struct.pack_into('=Q', self._mem, 8, tail + count)
+        return count
+
+class ShmSocket(object):
+    """Frames passed through a pair of shared memory rings, for two
+    processes forked from the one that called pair().
+
+    Each send_bytes rings a doorbell, one byte on a Unix socket, once as much
+    of its payload as fits is in the ring, and each recv_bytes answers one of
+    them, as ProtocolSocket's calls do.  So the socket is readable exactly
+    while a frame is outstanding and works with select() and epoll, while
+    payloads never pass through the kernel.  A payload larger than the ring
+    is streamed through it as the reader drains it.
+
+    A writer waits for room in the ring, so the proxy, which must never wait
+    on a slow peer, does not use it.  bench/transport_bench.py compares it
+    with the other transports.
+    """
+    def __init__(self, sock, tx, rx):
+        self._sock = sock
+        self._tx = tx
+        self._rx = rx
+
+    @classmethod
+    def pair(cls, size=1 << 22):
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        forward, backward = ShmRing(size), ShmRing(size)
+        return cls(a, forward, backward), cls(b, backward, forward)
+
+    def send_bytes(self, msg):
+        view = memoryview(msg)
+        view = view[self._tx.write(view):]
+        self._sock.sendall(b'd')
+        spins = 0
+        while len(view):
+            count = self._tx.write(view)
+            view = view[count:]
+            spins = 0 if count else spins + 1
+            if len(view):
+                self._wait(spins)
+
+    def recv_bytes(self, size):
+        if not self._sock.recv(1):
+            raise EOFError
+        buf = bytearray(size)
+        view = memoryview(buf)
+        spins = 0
+        while len(view):
+            count = self._rx.read_into(view)
+            view = view[count:]
+            spins = 0 if count else spins + 1
+            if len(view):
+                self._wait(spins)
+        return bytes(buf)
+
+    def _wait(self, spins):
+        """Back off while the peer catches up, giving up if it has gone."""
+        if spins % 1000 == 999:
+            try:
+                if not self._sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT):
+                    raise EOFError
+            except socket.error:
+                pass
+        time.sleep(0 if spins < 100 else 0.0005)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        self._sock.close()
+
+def set_nodelay(sock):
+    """Frames go out as a header and a payload write.  Over TCP, Nagle's
+    algorithm would hold the payload back until the header is acknowledged,
+    which the peer delays, so a small packet could take tens of milliseconds.
+    """
+    try:
+        dup = socket.fromfd(sock.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+    except (socket.error, OSError, AttributeError, ValueError):
+        return
+    try:
+        dup.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except socket.error:
+        pass # not TCP
+    finally:
+        dup.close()
+
 class ProtocolSocket(object):
     def __init__(self, sock):
         self._sock = sock
+        set_nodelay(sock)
         self._lock = threading.Lock()
+        self._codec = find_codec('json')
+
+    @property
+    def codec(self):
+        return self._codec.name
+
+    def set_codec(self, name):
+        self._codec = find_codec(name)
+
+    def negotiate(self, offered):
+        """Our most preferred codec that the peer also offered, falling back
+        to JSON, which every peer understands.
+
+        The caller acknowledges it to the peer and only then switches with
+        set_codec, so that the acknowledgement goes out in JSON, which is all
+        the peer accepts until it has switched too.
+        """
+        for name in available_codecs():
+            if name in offered:
+                return name
+        return 'json'
+
+    def encode(self, packet):
+        """The header and payload messages that send_packet would send."""
+        assert('dst' in packet.keys() and 'op' in packet.keys())
+        codec = self._codec
+        msg = bytes(codec.dumps(packet))
+        return HEADER.pack(len(msg), codec.ident), msg
+
+    def wire(self, messages):
+        """The bytes that sending `messages` puts on the underlying stream,
+        so that they can be written without blocking.  None if the
+        transport cannot be written to that way."""
+        if hasattr(self._sock, 'wire'):
+            return self._sock.wire(messages)
+        if isinstance(self._sock, Connection):
+            # multiprocessing frames each message with its length.
+            return b''.join(struct.pack('!i', len(msg)) + msg for msg in messages)
+        return None
 
     def send_packet(self, **kwargs):
-        assert('dst' in kwargs.keys() and 'op' in kwargs.keys())
-        msg = json.dumps(kwargs).encode('utf8')
+        self.send_messages(self.encode(kwargs))
+
+    def send_messages(self, messages):
         with self._lock:
             with suspended_signals(signal.SIGINT):
-                self._sock.send_bytes(struct.pack('I', len(msg)))
-                self._sock.send_bytes(bytes(msg))
+                for msg in messages:
+                    self._sock.send_bytes(msg)
 
     def recv_packet(self):
         with self._lock:
             with suspended_signals(signal.SIGINT):
-                size = int(struct.unpack('I', self._sock.recv_bytes(4))[0])
+                size, ident = HEADER.unpack(bytes(self._sock.recv_bytes(HEADER.size)))
                 r = bytes(self._sock.recv_bytes(size))
 
+                # Only JSON and the codec agreed on for this connection are
+                # decoded, so that a peer cannot have us unmarshal whatever
+                # it likes before or outside the handshake.
+                #
+                if ident not in (JSON_IDENT, self._codec.ident):
+                    raise MalformedPacket(r, "codec %d was not negotiated" % ident)
+                codec = self._codec if ident == self._codec.ident else find_codec('json')
+
                 try:
-                    r = r.decode('utf-8')
-                    r = json.loads(r)
-                    assert('dst' in r.keys() and 'op' in r.keys())
+                    r = codec.loads(r)
+                    assert(isinstance(r, dict) and 'dst' in r.keys() and 'op' in r.keys())
                 except UnicodeDecodeError:
                     raise MalformedPacket(r, "failed to decode unicode")
-                except ValueError:
-                    raise MalformedPacket(r, "failed to parse json")
+                except (ValueError, TypeError, EOFError):
+                    raise MalformedPacket(r, "failed to parse %s" % codec.name)
                 except AssertionError:
                     raise MalformedPacket(r, "packet is lacking 'dst' or 'op' field")
 
                 return r
 
+    def fill(self):
+        """Buffer what has arrived, without blocking, on transports that can.
+        EOFError once the peer has hung up."""
+        if hasattr(self._sock, 'fill'):
+            self._sock.fill()
+
+    def ready(self):
+        """Whether recv_packet would return without waiting on the peer: a
+        whole frame is buffered or, on transports that cannot tell, the
+        connection is readable."""
+        if hasattr(self._sock, 'has_frame'):
+            return self._sock.has_frame()
+        return self.poll()
+
     def recv_op(self, opname):
         c = self.recv_packet()
         if c['op'] != opname:
@@ -107,7 +607,14 @@ class ProtocolSocket(object):
     def fileno(self):
         return self._sock.fileno()
 
+    def pending(self):
+        """Whether a frame may already be buffered in user space, where
+        select() cannot see it."""
+        return hasattr(self._sock, 'pending') and self._sock.pending()
+
     def poll(self, timeout=0):
+        if self.pending():
+            return True
         ready = select.select([self._sock], [], [], timeout)[0]
         return len(ready) > 0
 
@@ -116,6 +623,8 @@ class ProtocolSocket(object):
 
     @staticmethod
     def select(socks, timeout=None):
-        ready = select.select(socks, [], [], timeout)[0]
+        buffered = [ sock for sock in socks if sock.pending() ]
+        ready = select.select(socks, [], [], 0 if buffered else timeout)[0]
+        ready = buffered + [ sock for sock in ready if sock not in buffered ]
         return filter(lambda sock: sock.poll(), ready)
 
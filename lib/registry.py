@@ -0,0 +1,135 @@
+"""
+Registry of the proxies running on this host, so that a client can find a
+session from the pid of its gdb, its inferior or the proxy itself with one
+file lookup.
+
+Each proxy keeps an entry, <proxy pid>.json, in registry_dir(), with links
+to it named after the other pids.
+
+    python registry.py [pid]
+"""
+import os, sys, json, time, errno
+
+def registry_dir():
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'exterminator')
+    uid = owner()
+    return '/tmp/exterminator-%d' % (os.getuid() if uid is None else uid[0])
+
+def owner():
+    """The user the registry belongs to, which is not root when gdb was
+    started under sudo."""
+    if 'SUDO_UID' in os.environ:
+        return int(os.environ['SUDO_UID']), int(os.environ.get('SUDO_GID', -1))
+    return None
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+def remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+class Registration(object):
+    """The entry of the running proxy, which is kept up to date with
+    update() and dropped with remove()."""
+    def __init__(self, **entry):
+        self.dir = registry_dir()
+        self.path = os.path.join(self.dir, '%d.json' % os.getpid())
+        self.links = []
+        self.entry = dict(entry, pid=os.getpid(), started=time.time())
+        try:
+            os.makedirs(self.dir, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            self.chown(self.dir)
+        self.write()
+
+    def chown(self, path):
+        uid = owner()
+        if uid is not None:
+            try:
+                os.lchown(path, *uid)
+            except OSError:
+                pass
+
+    def write(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(self.entry))
+        self.chown(tmp)
+        os.rename(tmp, self.path)
+
+        for link in self.links:
+            remove(link)
+        self.links = []
+        for key in ('gdb_pid', 'inferior_pid'):
+            if self.entry.get(key):
+                link = os.path.join(self.dir, str(self.entry[key]))
+                remove(link)
+                try:
+                    os.symlink(os.path.basename(self.path), link)
+                except OSError:
+                    continue
+                self.chown(link)
+                self.links.append(link)
+
+    def update(self, **changes):
+        if all(self.entry.get(key) == value for key, value in changes.items()):
+            return
+        self.entry.update(changes)
+        self.write()
+
+    def remove(self):
+        for link in self.links:
+            remove(link)
+        self.links = []
+        remove(self.path)
+
+def lookup(pid):
+    """The entry of the live proxy for the gdb, inferior or proxy `pid`, or
+    None if there is no such session."""
+    for name in (str(pid), '%d.json' % pid):
+        path = os.path.join(registry_dir(), name)
+        try:
+            entry = json.loads(open(path).read())
+        except (IOError, OSError, ValueError):
+            continue
+        if alive(entry['pid']):
+            return entry
+        remove(path)
+    return None
+
+def entries():
+    """The entries of every live proxy."""
+    try:
+        names = os.listdir(registry_dir())
+    except OSError:
+        return []
+    found = []
+    for name in sorted(names):
+        if name.endswith('.json'):
+            entry = lookup(int(name[:-len('.json')]))
+            if entry is not None:
+                found.append(entry)
+    return found
+
+if __name__ == '__main__':
+    if sys.argv[1:]:
+        found = [ lookup(int(sys.argv[1])) ]
+        if found[0] is None:
+            sys.stderr.write("No exterminator session for process %s\n" % sys.argv[1])
+            sys.exit(1)
+    else:
+        found = entries()
+    for entry in found:
+        print(json.dumps(entry))
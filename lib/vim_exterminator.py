@@ -1,19 +1,67 @@
 import os
 import time
+import json
 import select
+import base64
+import hashlib
+from collections import OrderedDict
 from subprocess import check_output, CalledProcessError
 from multiprocessing.connection import Client
-from protocol import ProtocolSocket, MalformedPacket
+from protocol import ProtocolSocket, MalformedPacket, available_codecs, StreamSocket
+
+def source_cache_dir():
+    cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'exterminator', 'sources')
 
 class RemoteGdb(object):
-    def __init__(self, vim, host, port, name="vim"):
+    def __init__(self, vim, host, port, name="vim", timeout=5, stream=0, path=None, observer=False,
+                 substitutions=None):
         self.vim = vim
-        self.sock = ProtocolSocket(Client((host, port)))
+        if path is not None:
+            self.sock = ProtocolSocket(StreamSocket.connect_unix(path))
+        else:
+            self.sock = ProtocolSocket(Client((host, port)))
         self.request_id = 0
         self.response = {}
+        self.pending = {}
+        self.timeout = timeout
         self.name = name
+        self.locals = {}
+        self.locals_token = None
+        self.stream = stream
+        self.streams = {}
+        # Source files gdb stops in that vim cannot open where they are are
+        # fetched from gdb into the cache.  `sources` maps gdb's names for
+        # them to where vim opens them, and `remote_paths` maps back.
+        #
+        self.sources = {}
+        self.remote_paths = {}
+        self.fetching = set()
+        self.unavailable = set()
+        self.substitutions = [ tuple(rule) for rule in substitutions or [] ]
+        # Until a file is in, the goto waiting for it and the signs gdb
+        # places in it are held back, so that they land on the fetched copy.
+        #
+        self.pending_goto = None
+        self.held_signs = {}
+        self.source_cache = source_cache_dir()
+        self.frame_rows = []
+        # The values gdb pushed for its watches at this stop, by expression,
+        # as [label, contents].
+        #
+        self.watched = OrderedDict()
 
-        self.send_command(op='name', name=name)
+        # An observer is told its own unique name, and gets copies of what
+        # the proxy sends vim addressed to 'observer'.
+        #
+        self.send_command(op='name', name=name, codecs=available_codecs(), observer=observer)
+        ack = self.sock.recv_op('codec')
+        self.sock.set_codec(ack['codec'])
+        self.notify_port = ack.get('notify')
+        self.name = ack.get('name', name)
+        self.observer = observer
+        if substitutions and not observer:
+            self.send_command(op='substitute', rules=[ list(rule) for rule in substitutions ])
 
     def send_command(self, **kwargs):
         self.request_id += 1
@@ -24,7 +72,66 @@ class RemoteGdb(object):
             self.quit(terminate_proxy=False)
         return self.request_id
 
+    def request(self, callback=None, **kwargs):
+        """Send a request whose response is delivered to `callback`, or kept
+        for get_response if there is none.  No trap is sent, so that several
+        requests can share one."""
+        request_id = self.send_command(**kwargs)
+        self.pending[request_id] = (time.time() + self.timeout, callback)
+        return request_id
+
+    def complete(self, c):
+        if c['request_id'] not in self.pending:
+            return # answered after its deadline
+        deadline, callback = self.pending.pop(c['request_id'])
+        if callback is not None:
+            callback(c)
+        else:
+            self.response[c['request_id']] = c
+
+    def add_chunk(self, c):
+        """Keep part of a streamed response until it is taken.  Each chunk
+        shows gdb is still working, so it renews the request's deadline."""
+        if c['request_id'] not in self.pending:
+            return
+        deadline, callback = self.pending[c['request_id']]
+        self.pending[c['request_id']] = (time.time() + self.timeout, callback)
+        stream = self.streams.setdefault(c['request_id'], { 'expr': c['expr'], 'contents': {} })
+        stream['contents'].update(c['contents'])
+
+    def take_stream(self, request_id):
+        """Wait for the next part of a streamed response and return it.
+        Until the whole response is in, the contents end with a node that
+        expands to the part after it."""
+        while request_id not in self.response and not self.streams.get(request_id, {}).get('contents'):
+            if request_id not in self.pending:
+                return { 'expr': "", 'contents': { 'Error: no such request': 0 } }
+            deadline, _ = self.pending[request_id]
+            try:
+                self.sock.poll(max(0, deadline - time.time()))
+                self.handle_events()
+            except select.error:
+                pass
+        stream = self.streams.get(request_id, { 'expr': "", 'contents': {} })
+        v = { 'expr': stream['expr'], 'contents': stream['contents'] }
+        stream['contents'] = {}
+        if request_id in self.response:
+            del self.streams[request_id]
+            response = self.response.pop(request_id)
+            v['contents'].update(response['contents'])
+            response['contents'] = v['contents']
+            return response
+        v['contents']["Loading..."] = "@stream:%d" % request_id
+        return v
+
+    def expire_requests(self):
+        now = time.time()
+        for request_id, (deadline, callback) in list(self.pending.items()):
+            if deadline <= now:
+                self.complete({ 'request_id': request_id, 'expr': "", 'contents': { 'Error: timeout': 0 } })
+
     def handle_events(self):
+        self.expire_requests()
         if not self.sock.poll():
             return
         while True:
@@ -37,17 +144,11 @@ class RemoteGdb(object):
             except MalformedPacket as e:
                 print "Malformed packet: %s" % e
                 continue
-            if c['dst'] == self.name:
-                if c['op'] == 'goto':
-                    window = self.find_window('navigation')
-                    if window is None:
-                        self.claim_window('navigation')
-                    c['filename'] = os.path.abspath(c['filename'])
-                    self.vim.command('badd %(filename)s' % c)
-                    self.vim.command("buffer %(filename)s" % c)
-                    self.vim.command("%(line)s" % c)
-                    self.vim.command("%(line)skP" % c)
-                    self.vim.command("norm zz")
+            if c['dst'] in (self.name, 'observer'):
+                if c['op'] == 'batch':
+                    self.apply_batch(c['ops'])
+                elif c['op'] == 'goto':
+                    self.goto(c)
                 elif c['op'] == 'disp':
                     winnr = int(self.vim.eval("winnr()"))
                     window = self.find_window('display', 'bot 15new')
@@ -57,13 +158,13 @@ class RemoteGdb(object):
                     self.vim.command("setlocal nomodifiable")
                     self.vim.command("%swincmd w" % winnr)
                 elif c['op'] == 'response':
-                    self.response[c['request_id']] = c
-                elif c['op'] == 'refresh':
-                    GDBPlugin = self.vim.bindeval('g:NERDTreeGDBPlugin')
-                    NERDTreeFromJSON = self.vim.Function('NERDTreeFromJSON')
-                    NERDTreeFromJSON(c['expr'], GDBPlugin)
+                    self.complete(c)
+                elif c['op'] == 'response_chunk':
+                    self.add_chunk(c)
+                elif c['op'] == 'watches':
+                    self.show_watches(c['values'])
                 elif c['op'] == 'place':
-                    c['filename'] = os.path.abspath(c['filename'])
+                    c['filename'] = self.local_path(c['filename'])
                     self.vim.command("badd %s" % c['filename'].replace('$', '\\$'))
                     c['bufnr'] = self.vim.eval("bufnr('%(filename)s')" % c)
                     self.vim.command("sign place %(num)s name=%(name)s line=%(line)s buffer=%(bufnr)s" % c)
@@ -77,7 +178,175 @@ class RemoteGdb(object):
             if not self.sock.poll():
                 return
 
+    def goto(self, c):
+        filename = self.source_path(c['filename'])
+        if filename is None:
+            # Goes once the file has been fetched, unless another goto has
+            # gone by then.
+            #
+            self.pending_goto = c if c['filename'] in self.fetching else None
+            return
+        self.pending_goto = None
+        window = self.find_window('navigation')
+        if window is None:
+            self.claim_window('navigation')
+        c = dict(c, filename=filename)
+        self.vim.command('badd %(filename)s' % c)
+        self.vim.command("buffer %(filename)s" % c)
+        if filename in self.remote_paths:
+            self.vim.command("setlocal readonly")
+        self.vim.command("%(line)s" % c)
+        self.vim.command("%(line)skP" % c)
+        self.vim.command("norm zz")
+
+    def local_path(self, filename):
+        """Where vim has gdb's `filename`, as far as is known yet."""
+        return self.sources.get(filename, os.path.abspath(filename))
+
+    def remote_path(self, filename):
+        return self.remote_paths.get(filename, filename)
+
+    def source_path(self, filename):
+        """Where vim should open gdb's `filename`, as it is or as rewritten
+        by a substitution rule.  A file that vim cannot see is fetched from
+        gdb.  A copy in the cache is used straight away and only checked
+        against gdb's in the background; without one, this is None until
+        source_fetched.  It is also None for files gdb could not send."""
+        if filename in self.sources:
+            return self.sources[filename]
+        if filename in self.unavailable:
+            return None
+        # gdb's own substitution rules often hold here as well
+        #
+        for path in [ filename ] + [ new + filename[len(old):] for old, new in self.substitutions
+                                     if filename.startswith(old) and filename[len(old):len(old) + 1] in ('', '/') ]:
+            if os.path.exists(path):
+                self.add_source(filename, os.path.abspath(path))
+                return self.sources[filename]
+        cached, digest = self.cached_source(filename)
+        self.fetch_source(filename, digest)
+        if digest is None:
+            return None
+        self.add_source(filename, cached)
+        return cached
+
+    def cached_source(self, filename):
+        """The cache file for gdb's `filename`, and the hash of what it holds
+        or None if it holds nothing yet."""
+        key = hashlib.sha1(filename if isinstance(filename, bytes) else filename.encode('utf-8')).hexdigest()[:16]
+        cached = os.path.join(self.source_cache, key, os.path.basename(filename))
+        try:
+            meta = json.loads(open(cached + '.meta').read())
+            return cached, meta['hash'] if meta['filename'] == filename else None
+        except (IOError, OSError, ValueError, KeyError):
+            return cached, None
+
+    def add_source(self, filename, local):
+        self.sources[filename] = local
+        self.remote_paths[local] = filename
+
+    def fetch_source(self, filename, digest):
+        if filename in self.fetching:
+            return
+        self.fetching.add(filename)
+        def _fetched(c):
+            self.fetching.discard(filename)
+            if 'hash' in c:
+                self.store_source(filename, c)
+            elif 'error' in c:
+                self.unavailable.add(filename)
+                print "Could not fetch %s: %s" % (filename, c['error'])
+            else:
+                # Timed out.  The next time gdb stops in the file, it is
+                # asked for again.
+                #
+                print "Could not fetch %s: %s" % (filename, ", ".join(c.get('contents', {})))
+            self.source_fetched(filename)
+        self.request(_fetched, op='source', filename=filename, hash=digest)
+        self.send_trap()
+
+    def store_source(self, filename, c):
+        cached, _ = self.cached_source(filename)
+        if not c.get('unchanged'):
+            data = c['text'].encode('utf-8') if 'text' in c else base64.b64decode(c['data'])
+            try:
+                if not os.path.isdir(os.path.dirname(cached)):
+                    os.makedirs(os.path.dirname(cached))
+                with open(cached, 'wb') as f:
+                    f.write(data)
+                with open(cached + '.meta', 'w') as f:
+                    f.write(json.dumps({ 'filename': filename, 'hash': c['hash'] }))
+            except (IOError, OSError) as e:
+                print "Could not cache %s: %s" % (filename, e)
+                return
+            if cached in self.remote_paths:
+                self.vim.command("checktime %s" % cached.replace(' ', '\\ '))
+        self.add_source(filename, cached)
+
+    def source_fetched(self, filename):
+        """Place the signs held back for `filename`, on the fetched copy if
+        there is one, and go to it if a goto is still waiting for it."""
+        held = self.held_signs.pop(filename, None)
+        if held:
+            for sign in held.values():
+                sign['buffer'] = self.local_path(filename)
+            ExterminatorSigns = self.vim.Function('ExterminatorSigns')
+            ExterminatorSigns(self.vim.List([]), self.vim.List(list(held.values())))
+        goto, self.pending_goto = self.pending_goto, None
+        if goto is not None and goto['filename'] == filename and filename in self.sources:
+            self.goto(goto)
+
+    def apply_batch(self, ops):
+        """Apply the sign and goto operations gdb queued over one prompt.  All
+        of the signs are placed by a single call into vim.  Signs in a file
+        that is being fetched are held back until it is in."""
+        gotos = [ c for c in ops if c['op'] == 'goto' ]
+        if gotos:
+            self.source_path(gotos[-1]['filename']) # starts fetching it before its signs come up
+        place, unplace, goto = [], [], None
+        for c in ops:
+            if c['op'] in ('place', 'replace', 'unplace'):
+                held = self.hold_sign(c)
+            if c['op'] == 'place' and not held:
+                place.append({ 'id': c['num'], 'name': c['name'], 'lnum': c['line'], 'buffer': self.local_path(c['filename']) })
+            elif c['op'] == 'replace' and not held:
+                place.append({ 'id': c['num'], 'name': c['name'], 'buffer': self.local_path(c['filename']) })
+            elif c['op'] == 'unplace':
+                unplace.append({ 'id': c['num'] })
+            elif c['op'] == 'goto':
+                goto = c
+        if place or unplace:
+            ExterminatorSigns = self.vim.Function('ExterminatorSigns')
+            ExterminatorSigns(self.vim.List(unplace), self.vim.List(place))
+        if goto is not None:
+            self.goto(goto)
+
+    def hold_sign(self, c):
+        """Keep a sign operation for a file that is being fetched, and drop
+        held signs that it supersedes.  True if it was kept."""
+        holder = None
+        for filename, held in self.held_signs.items():
+            if c['num'] in held:
+                holder = held
+        if c['op'] == 'replace' and holder is not None:
+            holder[c['num']]['name'] = c['name']
+            return True
+        if holder is not None:
+            del holder[c['num']]
+        if c['op'] == 'place' and c['filename'] in self.fetching and c['filename'] not in self.sources:
+            self.held_signs.setdefault(c['filename'], OrderedDict())[c['num']] = \
+                { 'id': c['num'], 'name': c['name'], 'lnum': c['line'] }
+            return True
+        return False
+
     def quit(self, terminate_proxy=True):
+        if self.vim is None:
+            # A scripting client like gdb_exec
+            #
+            self.pending.clear()
+            self.sock.close()
+            return
+        self.vim.command("call ExterminatorCloseNotify()")
         self.vim.command("sign unplace *")
         winnr = int(self.vim.eval("winnr()"))
         window = self.find_window('display')
@@ -105,22 +374,40 @@ class RemoteGdb(object):
         self.send_command(op='exec', comm=comm)
         self.send_trap()
 
+    def exec_many(self, comms):
+        """Run several commands with their output captured, behind a single
+        trap.  Yields each command's response, with its `output` and `error`,
+        in order."""
+        request_ids = [ self.request(op='exec', comm=comm, capture=True) for comm in comms ]
+        if request_ids:
+            self.send_trap()
+        for request_id in request_ids:
+            yield self.get_response(request_id)
+
     def disable_break(self, filename, line):
-        self.send_command(op='disable', loc=(filename, line))
+        self.send_command(op='disable', loc=(self.remote_path(filename), line))
         self.send_trap()
 
     def toggle_break(self, filename, line):
-        self.send_command(op='toggle', loc=(filename, line))
+        self.send_command(op='toggle', loc=(self.remote_path(filename), line))
         self.send_trap()
 
     def continue_until(self, filename, line):
-        self.send_command(op='until', loc=(filename, line))
+        self.send_command(op='until', loc=(self.remote_path(filename), line))
         self.send_trap()
 
     def eval_expr(self, expr):
-        request_id = self.send_command(op='eval', expr=str(expr))
+        request_id = self.request(op='eval', expr=str(expr))
+        self.send_trap()
         return self.get_response(request_id)
 
+    def stats(self):
+        """Counters from gdb's value cache and the proxy's send queues."""
+        proxy = self.request(dst='proxy', op='stats')
+        gdb = self.request(op='stats')
+        self.send_trap()
+        return { 'proxy': self.get_response(proxy).get('stats'), 'gdb': self.get_response(gdb).get('stats') }
+
     def set_tmux_pane(self):
         try:
             pane = check_output([ "tmux", "display-message", "-p", "#D" ]).strip()
@@ -129,23 +416,34 @@ class RemoteGdb(object):
             print e
 
     def get_response(self, request_id):
-        start = time.time()
         while request_id not in self.response:
-            self.send_trap()
+            if request_id not in self.pending:
+                return { 'expr': "", 'contents': { 'Error: no such request': 0 } }
+            deadline, _ = self.pending[request_id]
             try:
-                self.sock.poll(1)
+                self.sock.poll(max(0, deadline - time.time()))
                 self.handle_events()
             except select.error:
                 pass
-            if time.time() - start > 5:
-                return { 'expr': "", 'contents': { 'Error: timeout': 0 } }
         response = self.response[request_id]
         del self.response[request_id]
         return response
 
     def fetch_children(self, expr):
         try:
-            v = self.eval_expr(expr)
+            node = self.pushed_children(expr)
+            if node is not None:
+                return node
+            if expr.startswith('@stream:'):
+                v = self.take_stream(int(expr[len('@stream:'):]))
+            else:
+                request_id = self.request(**self.eval_command(expr))
+                self.send_trap()
+                v = self.take_stream(request_id) if self.stream and expr != 'auto' else self.get_response(request_id)
+            if 'token' in v:
+                self.apply_locals(v)
+            if v.get('partial'):
+                print "%s is too large to expand at once; unexpanded entries load on demand." % v['expr']
             return [ v['expr'], v['contents'] ]
         except:
             import traceback
@@ -153,27 +451,150 @@ class RemoteGdb(object):
             p = len("%d" % len(lines))
             return [ "Python client error", { "%0*d: %s" % (p, i, line): {} for i, line in enumerate(lines) } ]
 
+    def eval_command(self, expr):
+        # Leave gdb half of our deadline, so that a partial answer arrives in
+        # time instead of the whole request timing out.
+        #
+        budget = { 'seconds': self.timeout / 2.0 }
+        if expr == 'auto':
+            return dict(op='eval', expr='auto', delta=True, since=self.locals_token, budget=budget)
+        if self.stream:
+            return dict(op='eval', expr=str(expr), budget=budget, stream=self.stream)
+        return dict(op='eval', expr=str(expr), budget=budget)
+
+    def apply_locals(self, v):
+        """Bring our copy of the locals up to date from a full or delta
+        response, and fill in the response's contents from it."""
+        if 'variables' in v:
+            self.locals = dict(v['variables'])
+        else:
+            for var in v['removed']:
+                self.locals.pop(var, None)
+            self.locals.update(v['changed'])
+        self.locals_token = v['token']
+        contents = {}
+        for rendered in self.locals.values():
+            contents.update(rendered)
+        v['contents'] = contents
+
+    def pushed_children(self, expr):
+        if expr == '@watches':
+            # Locals we could not bring up to date are fetched when expanded
+            #
+            return [ expr, dict(node or [ 'locals', watch ] for watch, node in self.watched.items()) ]
+        return self.watched.get(expr)
+
+    def show_watches(self, values):
+        """Keep the values gdb pushed for its watches and draw them: a single
+        watch as the root of the tree, several under one root."""
+        self.watched = OrderedDict()
+        for v in values:
+            if 'token' in v and 'variables' not in v and v['since'] != self.locals_token:
+                # Locals as a delta on a copy we do not have, which happens
+                # when a push is superseded.  They are fetched when drawn.
+                #
+                self.watched[v['expr']] = None
+                continue
+            if 'token' in v:
+                self.apply_locals(v)
+                self.watched[v['expr']] = [ 'locals', v['contents'] ]
+            elif len(v['contents']) == 1:
+                self.watched[v['expr']] = list(list(v['contents'].items())[0])
+            else:
+                self.watched[v['expr']] = [ v['expr'], v['contents'] ]
+            if v.get('partial'):
+                print "%s is too large to expand at once; unexpanded entries load on demand." % v['expr']
+        if not values:
+            return
+        GDBPlugin = self.vim.bindeval('g:NERDTreeGDBPlugin')
+        NERDTreeFromJSON = self.vim.Function('NERDTreeFromJSON')
+        NERDTreeFromJSON(values[0]['expr'] if len(values) == 1 else '@watches', GDBPlugin)
+
     def track_expr(self, expr):
-        if expr is not None:
-            GDBPlugin = self.vim.bindeval('g:NERDTreeGDBPlugin')
-            NERDTreeFromJSON = self.vim.Function('NERDTreeFromJSON')
-            NERDTreeFromJSON(expr, GDBPlugin)
+        """Watch `expr` alone, or nothing if it is None."""
         self.send_command(op='track', expr=expr)
+        self.send_trap()
+
+    def watch_expr(self, expr):
+        self.send_command(op='watch', expr=str(expr))
+        self.send_trap()
+
+    def unwatch_expr(self, expr=None):
+        """Stop watching `expr`, or every expression if it is None."""
+        if expr is None:
+            self.watched.clear()
+        else:
+            self.watched.pop(expr, None)
+        self.send_command(op='unwatch', expr=expr)
+        self.send_trap()
 
     def print_expr(self, expr):
         GDBPlugin = self.vim.bindeval('g:NERDTreeGDBPlugin')
         NERDTreeFromJSON = self.vim.Function('NERDTreeFromJSON')
         NERDTreeFromJSON(expr, GDBPlugin)
 
-    def show_backtrace(self):
-        request_id = self.send_command(op='bt')
+    def show_backtrace(self, start=0):
+        """List a page of the selected thread's frames with their arguments.
+        The last entry leads to the next page."""
+        count = int(self.vim.eval("get(g:, 'exterminator_backtrace_page', 100)"))
+        request_id = self.request(op='bt', start=start, count=count, args=True)
+        self.send_trap()
+        response = self.get_response(request_id)
+        entries, rows = [], []
+        for level, frame in enumerate(response.get('bt', []), start):
+            entries.append(self.frame_entry(level, *frame))
+            rows.append({ 'level': level })
+        if response.get('more'):
+            entries.append({ 'text': "More frames..." })
+            rows.append({ 'page': start + len(response['bt']) })
+        self.show_frames(entries, rows)
+
+    def show_all_backtraces(self):
+        """List the stack of every thread, once for all of the threads that
+        share it."""
+        depth = int(self.vim.eval("get(g:, 'exterminator_backtrace_page', 100)"))
+        request_id = self.request(op='bt', threads=True, count=depth)
+        self.send_trap()
         response = self.get_response(request_id)
-        my_llist = self.vim.List([{ 'filename': filename, 'lnum': line, 'text': contents } for filename, line, contents in response['bt'] ])
+        entries, rows = [], []
+        for group in response.get('groups', []):
+            threads = group['threads']
+            entries.append({ 'text': "Thread%s %s" % ("s" if len(threads) > 1 else "", ", ".join(str(n) for n in threads)) })
+            rows.append({ 'thread': threads[0] })
+            for level, frame in enumerate(group['frames']):
+                entries.append(self.frame_entry(level, *frame))
+                rows.append({ 'thread': threads[0], 'level': level })
+            if group.get('more'):
+                entries.append({ 'text': "..." })
+                rows.append({ 'thread': threads[0] })
+        self.show_frames(entries, rows)
+
+    def frame_entry(self, level, filename, line, name, args):
+        return { 'filename': self.local_path(filename) if filename else "", 'lnum': line,
+                 'text': "#%d %s(%s)" % (level, name, args) }
+
+    def show_frames(self, entries, rows):
+        self.frame_rows = rows
         setloclist = self.vim.Function('setloclist')
-        setloclist(0, my_llist)
+        setloclist(0, self.vim.List(entries))
         self.vim.command('lopen')
         self.vim.command('GdbBindBufferToFrame')
 
+    def select_frame(self, row):
+        """Select the thread and frame on line `row` of a backtrace, or show
+        the page it leads to."""
+        if not 0 < row <= len(self.frame_rows):
+            return
+        target = self.frame_rows[row - 1]
+        if 'page' in target:
+            self.show_backtrace(target['page'])
+            return
+        if 'thread' in target:
+            self.send_command(op='exec', comm='thread %d' % target['thread'])
+        if 'level' in target:
+            self.send_command(op='exec', comm='frame %d' % target['level'])
+        self.send_trap()
+
     def claim_window(self, window_name):
         self.vim.command('let w:mandrews_output_window = "%s"' % window_name)
 
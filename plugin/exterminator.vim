@@ -9,14 +9,21 @@ import vim_exterminator
 
 vim.gdb = None
 
-def InitRemoteGdb(host_port=None):
+def InitRemoteGdb(host_port=None, observer=False):
+    path = None
     if host_port is None:
         try:
             exterminator_file = vim.eval('g:exterminator_file')
-            host, port = json.loads(open(exterminator_file, 'r').read())
+            address = json.loads(open(exterminator_file, 'r').read())
+            if isinstance(address, dict):
+                host, port, path = address['host'], address['port'], address.get('unix')
+            else:
+                host, port = address
         except Exception as e:
             vim.command("echoerr 'Problem encountered initializing GDB from file %s: %s'" % (exterminator_file, str(e)))
         vim.command("unlet g:exterminator_file")
+    elif host_port[:1] in ('@', '/'):
+        host, port, path = '127.0.0.1', 0, host_port
     else:
         try:
             host, port = host_port.split(':')
@@ -25,11 +32,17 @@ def InitRemoteGdb(host_port=None):
         except:
             vim.command("echoerr 'Could not parse integer: %s'" % port)
     try:
-        vim.gdb = vim_exterminator.RemoteGdb(vim, host, port)
-        vim.gdb.set_tmux_pane()
+        timeout = float(vim.eval("get(g:, 'exterminator_timeout', 5)"))
+        stream = int(vim.eval("get(g:, 'exterminator_stream', 0)"))
+        substitutions = vim.eval("get(g:, 'exterminator_substitute_path', [])")
+        vim.gdb = vim_exterminator.RemoteGdb(vim, host, port, timeout=timeout, stream=stream, path=path, observer=observer,
+                                             substitutions=substitutions)
+        if not vim.gdb.notify_port or not int(vim.eval("ExterminatorOpenNotify('%s', %d, '%s')" % (host, vim.gdb.notify_port, vim.gdb.name))):
+            if not observer:
+                vim.gdb.set_tmux_pane()
         vim.gdb.handle_events()
     except:
-        vim.command("echoerr 'Could not connect to %s:%d'" % (host, port))
+        vim.command("echoerr 'Could not connect to %s'" % (path or "%s:%d" % (host, port)))
 
 EOF
 
@@ -50,6 +63,83 @@ function! HistPreserve(cmd)
     exec a:cmd
 endfunction
 
+" Unplace and place lists of signs, given as for sign_unplacelist() and
+" sign_placelist() but with buffers named by file.  Vims without those
+" functions get the equivalent :sign commands.
+"
+function! ExterminatorSigns(unplace, place)
+    for sign in a:place
+        if exists('*bufadd')
+            let sign.buffer = bufadd(sign.buffer)
+            " Listed, as :badd would leave it
+            call setbufvar(sign.buffer, '&buflisted', 1)
+        else
+            exec 'badd ' . fnameescape(sign.buffer)
+            let sign.buffer = bufnr(sign.buffer)
+        endif
+    endfor
+    if exists('*sign_placelist')
+        call sign_unplacelist(a:unplace)
+        call sign_placelist(a:place)
+        return
+    endif
+    for sign in a:unplace
+        exec 'sign unplace ' . sign.id
+    endfor
+    for sign in a:place
+        let line = has_key(sign, 'lnum') ? ' line=' . sign.lnum : ''
+        exec 'sign place ' . sign.id . line . ' name=' . sign.name . ' buffer=' . sign.buffer
+    endfor
+endfunction
+
+" The proxy writes a line to the notify channel whenever gdb has something
+" for us, so packets are handled as they arrive rather than on CursorHold or
+" through tmux.
+"
+let s:notify = v:null
+
+function! ExterminatorNotify(...)
+    GdbRefresh
+endfunction
+
+function! ExterminatorOpenNotify(host, port, name)
+    let address = a:host . ':' . a:port
+    try
+        if has('nvim')
+            let s:notify = sockconnect('tcp', address, { 'on_data': function('ExterminatorNotify') })
+            call chansend(s:notify, a:name . "\n")
+        elseif has('channel')
+            let s:notify = ch_open(address, { 'mode': 'nl', 'callback': 'ExterminatorNotify' })
+            if ch_status(s:notify) != 'open'
+                let s:notify = v:null
+                return 0
+            endif
+            call ch_sendraw(s:notify, a:name . "\n")
+        else
+            return 0
+        endif
+    catch
+        let s:notify = v:null
+        return 0
+    endtry
+    return 1
+endfunction
+
+function! ExterminatorCloseNotify()
+    if s:notify is v:null
+        return
+    endif
+    try
+        if has('nvim')
+            call chanclose(s:notify)
+        else
+            call ch_close(s:notify)
+        endif
+    catch
+    endtry
+    let s:notify = v:null
+endfunction
+
 let s:Plugin = {}
 function! s:Plugin.FetchChildren(str)
     let ret = pyeval('vim.gdb.fetch_children(vim.eval("a:str"))')
@@ -81,7 +171,10 @@ comm! -nargs=1                      GdbExec                 python vim.gdb is No
 comm! -nargs=1                      GdbEval                 python vim.gdb is None or vim.gdb.print_expr(<f-args>)
 comm! -nargs=0                      GdbLocals               python vim.gdb is None or vim.gdb.track_expr('auto')
 comm! -nargs=0                      GdbNoTrack              python vim.gdb is None or vim.gdb.track_expr(None)
-comm! -nargs=0                      GdbBacktrace            python vim.gdb is None or vim.gdb.show_backtrace()
+comm! -nargs=1                      GdbWatch                python vim.gdb is None or vim.gdb.watch_expr(<q-args>)
+comm! -nargs=?                      GdbUnwatch              python vim.gdb is None or vim.gdb.unwatch_expr(<q-args> or None)
+comm! -nargs=?                      GdbBacktrace            python vim.gdb is None or vim.gdb.show_backtrace(int(<q-args> or 0))
+comm! -nargs=0                      GdbBacktraceAll         python vim.gdb is None or vim.gdb.show_all_backtraces()
 
 comm! -nargs=0                      GdbContinue             python vim.gdb is None or vim.gdb.send_continue()
 comm! -nargs=0                      GdbToggle               python vim.gdb is None or vim.gdb.toggle_break(vim.eval("expand('%:p')"), int(vim.eval("line('.')")))
@@ -91,10 +184,12 @@ comm! -nargs=0                      GdbNext                 GdbExec next
 comm! -nargs=0                      GdbStep                 GdbExec step
 comm! -nargs=0                      GdbUntil                python vim.gdb is None or vim.gdb.continue_until(vim.eval("expand('%:p')"), int(vim.eval("line('.')")))
 comm! -nargs=0                      GdbQuit                 python vim.gdb is None or vim.gdb.quit()
-comm! -nargs=0                      GdbBindBufferToFrame    nnoremap <buffer> <cr> :exec "GdbExec f " . string(line(".") - 1)<cr><cr>
+comm! -nargs=0                      GdbBindBufferToFrame    nnoremap <buffer> <cr> :python vim.gdb is None or vim.gdb.select_frame(int(vim.eval("line('.')")))<cr>
 
 comm! -nargs=0                      GdbRefresh              python vim.gdb is None or vim.gdb.handle_events()
+comm! -nargs=0                      GdbStats                python vim.gdb is None or sys.stdout.write(json.dumps(vim.gdb.stats(), indent=1, sort_keys=True))
 comm! -nargs=?                      GdbConnect              python InitRemoteGdb(<f-args>)
+comm! -nargs=1                      GdbObserve              python InitRemoteGdb(<f-args>, observer=True)
 
 comm! -nargs=+ -complete=shellcmd   GdbStartDebugger        call s:StartDebugger(<f-args>)
 comm! -nargs=+ -complete=shellcmd   Dbg                     call s:StartDebugger('-ex r', '--args', <f-args>)
@@ -106,6 +201,6 @@ sign define just_pc text=-- texthl=Debug
 sign define pc_and_breakpoint text=-> texthl=Debug
 sign define dummy
 
-au CursorHold *             GdbRefresh
+au CursorHold *             if s:notify is v:null | GdbRefresh | endif
 
 let g:NERDTreeSortOrder = [ '*' ]